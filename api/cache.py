@@ -0,0 +1,76 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    带过期时间的 LRU 缓存, 内存中最多保留 maxsize 条;
+    指定 path 时同时写入本地 SQLite 文件, 进程重启或多个进程之间可以共用(值需要能 json 序列化)
+    :param ttl:     默认过期时间(秒)
+    :param maxsize: 最多缓存的条数
+    :param path:    SQLite 文件路径, 不传则只缓存在内存中
+    """
+
+    def __init__(self, ttl=86400, maxsize=256, path=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # {key: (expires_at, value)}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+            self._db.commit()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None and self._db is not None:
+                row = self._db.execute("SELECT expires_at, value FROM cache WHERE key = ?", (key,)).fetchone()
+                if row:
+                    item = (row[0], json.loads(row[1]))
+                    self._put(key, item)
+            if item is None:
+                return default
+            if item[0] <= now:
+                self._data.pop(key, None)
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        item = (time.time() + (ttl or self.ttl), value)
+        with self._lock:
+            self._put(key, item)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), item[0]),
+                )
+                self._db.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+                self._db.execute(
+                    "DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY expires_at DESC LIMIT ?)",
+                    (self.maxsize,),
+                )
+                self._db.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._db.commit()
+
+    def _put(self, key, item):
+        self._data[key] = item
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+default_cache = TTLCache()
@@ -0,0 +1,122 @@
+import asyncio
+import random
+import time
+
+
+THROTTLE_CODES = {52101, 52102, 52103, 70031}  # 当前接口被限流/接口暂时不可用/服务暂时不可用/调用过于频繁
+
+
+def is_throttled(err):
+    return isinstance(err, dict) and err.get("error_code") in THROTTLE_CODES
+
+
+class TokenBucket:
+    """
+    令牌桶, 同一个桶被多个协程共用时按先来后到排队取令牌
+    :param rate:    每秒生成的令牌数(QPS)
+    :param burst:   桶容量, 允许的突发请求数
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = None
+        self._loop = None
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0  # 等待令牌的总时间(秒)
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # 限流器可能被多次运行(每次新建事件循环)共用, 锁跟随当前事件循环重建
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        async with self._lock:
+            begin = now = time.monotonic()
+            while True:
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    now = time.monotonic()
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                now = time.monotonic()
+            self.requests += 1
+            self.waited += now - begin
+
+    def block(self, seconds):
+        """被限流后暂停整个桶, 共用此桶的其他协程也一起等待"""
+        self.throttled += 1
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class Backoff:
+    """
+    指数退避 + 随机抖动(full jitter)
+    :param base:            第一次重试的基准等待时间(秒)
+    :param cap:             单次等待时间上限(秒)
+    :param max_attempts:    最多请求次数(含第一次)
+    """
+
+    def __init__(self, base=0.2, cap=10.0, max_attempts=6):
+        self.base = base
+        self.cap = cap
+        self.max_attempts = max_attempts
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+
+class RateLimiter:
+    """
+    按 (client_id, api_name) 分桶的限流器
+    :param rate:        默认 QPS
+    :param burst:       默认突发数
+    :param overrides:   单独配置的接口 {api_name: (rate, burst)}
+    :param total_rate:  所有店铺所有接口合计的 QPS 上限, 不传则不限制
+    """
+
+    def __init__(self, rate=10, burst=10, overrides=None, total_rate=None):
+        self.rate = rate
+        self.burst = burst
+        self.overrides = overrides or {}
+        self._buckets = {}
+        self._total = TokenBucket(total_rate, max(1, int(total_rate))) if total_rate else None
+
+    async def acquire(self, bucket):
+        """先取全局令牌再取接口令牌"""
+        if self._total is not None:
+            await self._total.acquire()
+        await bucket.acquire()
+
+    def get_bucket(self, client_id, api_name):
+        key = (client_id, api_name)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, burst = self.overrides.get(api_name, (self.rate, self.burst))
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def stats(self):
+        stats = {
+            key: {"requests": b.requests, "throttled": b.throttled, "waited": round(b.waited, 3)}
+            for key, b in self._buckets.items()
+        }
+        if self._total is not None:
+            stats["total"] = {"requests": self._total.requests, "waited": round(self._total.waited, 3)}
+        return stats
+
+
+default_limiter = RateLimiter()
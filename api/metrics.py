@@ -0,0 +1,177 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+"""
+进程内的计数器/仪表/直方图, 可以输出为 Prometheus 文本格式, 或写入文件供 node_exporter 的 textfile collector 采集
+写库线程和事件循环都会更新指标, 每个指标自带锁
+"""
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # {label values: value}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("%s 需要的标签为 %s, 实际为 %s" % (self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+    def samples(self):
+        """:return: [(name, labels, value)]"""
+        with self._lock:
+            return [(self.name, self._format_labels(key), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.type)]
+        lines.extend("%s%s %s" % (name, labels, format_value(value)) for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * len(self.buckets), 0, 0.0]  # [各区间计数, 总数, 总和]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                item[0][index] += 1
+            item[1] += 1
+            item[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def get(self, **labels):
+        """:return: (总数, 总和)"""
+        item = self._values.get(self._key(labels))
+        return (item[1], item[2]) if item else (0, 0.0)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, amount) in self._values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    samples.append((self.name + "_bucket", self._format_labels(key, ("le", format_value(bound))),
+                                    cumulative))
+                samples.append((self.name + "_bucket", self._format_labels(key, ("le", "+Inf")), total))
+                samples.append((self.name + "_count", self._format_labels(key), total))
+                samples.append((self.name + "_sum", self._format_labels(key), amount))
+        return samples
+
+
+class Registry:
+    """同名指标只创建一次, 模块重复导入或多处声明时返回同一个对象"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError("指标%s已经以不同的类型或标签注册" % name)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        """Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() + "\n" for metric in metrics)
+
+    def write(self, path):
+        """先写临时文件再替换, 采集方不会读到写了一半的文件"""
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+default_registry = Registry()
@@ -1,20 +1,103 @@
 import asyncio
+import os
+import time
 import aiohttp
 from datetime import datetime
 from hashlib import md5
+from collections import deque
+from itertools import count
 from typing import Union
 
+try:
+    from orjson import loads as json_loads  # 可选依赖, 解析大页订单比标准库快很多
+except ImportError:
+    from json import loads as json_loads
+
+from api.cache import default_cache
+from api.limiter import Backoff, default_limiter, is_throttled
+from api.metrics import default_registry
+
+
+API_LATENCY = default_registry.histogram("pdd_api_request_seconds", "拼多多接口单次请求耗时", ["api"])
+API_REQUESTS = default_registry.counter(
+    "pdd_api_requests_total", "拼多多接口请求次数, result 为 ok/error/throttled", ["api", "result"])
+API_RETRIES = default_registry.counter("pdd_api_retries_total", "拼多多接口被限流后的重试次数", ["api"])
+RATE_LIMIT_WAIT = default_registry.histogram("pdd_rate_limit_wait_seconds", "请求前等待本地限流令牌的时间", ["api"])
+PAGES = default_registry.counter("pdd_pages_total", "分页接口返回的页数", ["list_key"])
+RECORDS = default_registry.counter("pdd_records_total", "分页接口返回的记录数", ["list_key"])
+
+
+class PddApiError(Exception):
+    pass
+
 
 class Pdd:
-    _base_url = "https://gw-api.pinduoduo.com/api/router"
+    _base_url = os.environ.get("PDD_BASE_URL", "https://gw-api.pinduoduo.com/api/router")  # 压测时指向本地网关
     _headers = {"content-type": "application/json"}
-    _logistics_company = {}  # "id": 463,
+    # 参考数据的缓存时间(秒)
+    _logistics_company_ttl = 86400
+    _logistics_address_ttl = 7 * 86400
+    _mall_info_ttl = 86400
 
-    def __init__(self, client_id, client_secret, access_token):
+    def __init__(self, client_id, client_secret, access_token, *, session=None, base_url=None, limiter=None,
+                 backoff=None, cache=None, **connector_kwargs):
+        """
+        :param session:             共用的 aiohttp.ClientSession, 不传则由本实例自行创建并在 close() 时关闭
+        :param base_url:            网关地址, 默认环境变量 PDD_BASE_URL 或拼多多正式网关
+        :param limiter:             限流器 RateLimiter, 默认所有实例共用 default_limiter
+        :param backoff:             被限流后的退避策略 Backoff
+        :param cache:               物流公司/地址库/店铺信息等参考数据的缓存 TTLCache, 默认所有实例共用 default_cache
+        :param connector_kwargs:    自建连接池的参数, 见 create_client_session
+        """
         self._client_id = client_id
         self._client_secret = client_secret
+        self._signer = Signer(client_secret)
         self._access_token = access_token
         self._mall_info = {}
+        if base_url:
+            self._base_url = base_url
+        self._session = session
+        self._own_session = session is None
+        self._connector_kwargs = connector_kwargs
+        self._limiter = limiter or default_limiter
+        self._backoff = backoff or Backoff()
+        self._cache = cache or default_cache
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @property
+    def client_id(self):
+        return self._client_id
+
+    @property
+    def client_secret(self):
+        return self._client_secret
+
+    @property
+    def access_token(self):
+        return self._access_token
+
+    @access_token.setter
+    def access_token(self, value):
+        # token 刷新后沿用原实例, 保留连接池和店铺信息等缓存
+        self._access_token = value
+
+    @property
+    def session(self):
+        # 连接池延迟创建, 保证在事件循环内初始化
+        if self._session is None or self._session.closed:
+            self._session = create_client_session(**self._connector_kwargs)
+            self._own_session = True
+        return self._session
+
+    async def close(self):
+        if self._own_session and self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     def get_common_params(self, api_name):
         return {  # 必填的公共请求参数
@@ -27,12 +110,32 @@ class Pdd:
     @property
     async def mall_info(self):
         if not self._mall_info:
-            self._mall_info = await self._get_mall_info()
+            key = "mall_info:%s:%s" % (self._client_id, md5(self._access_token.encode("utf-8")).hexdigest())
+            self._mall_info = self._cache.get(key)
+            if not self._mall_info:
+                self._mall_info = await self._get_mall_info()
+                self._cache.set(key, self._mall_info, self._mall_info_ttl)
         return self._mall_info
 
     async def send_post(self, data: dict):
-        data["sign"] = get_sign(data)
-        return await send_pdd_request("POST", self._base_url, json=data, headers=self._headers)
+        data["sign"] = self._signer.sign(data)
+        api_name = data["type"]
+        bucket = self._limiter.get_bucket(self._client_id, api_name)
+        for attempt in range(1, self._backoff.max_attempts + 1):
+            with RATE_LIMIT_WAIT.time(api=api_name):
+                await self._limiter.acquire(bucket)
+            started = time.perf_counter()
+            result, err = await send_pdd_request(
+                "POST", self._base_url, json=data, headers=self._headers, session=self.session)
+            API_LATENCY.observe(time.perf_counter() - started, api=api_name)
+            if not is_throttled(err):
+                API_REQUESTS.inc(api=api_name, result="error" if err else "ok")
+                break
+            API_REQUESTS.inc(api=api_name, result="throttled")
+            if attempt < self._backoff.max_attempts:
+                API_RETRIES.inc(api=api_name)
+                bucket.block(self._backoff.delay(attempt))
+        return result, err
 
     async def get_access_token(self, code):
         api_name = "pdd.pop.auth.token.create"
@@ -99,15 +202,17 @@ class Pdd:
     async def get_logistics_company(self, _id):
         if not _id:
             return ""
-        if not self._logistics_company:
+        logistics_company = self._cache.get("logistics_company")  # {"463": "xx快递"}
+        if not logistics_company:
             api_name = "pdd.logistics.companies.get"
             data = self.get_common_params(api_name)
             result, err = await self.send_post(data)
-            if not err:
-                result = result["logistics_companies_get_response"]["logistics_companies"]
-                for i in result:
-                    self._logistics_company[i["id"]] = i["logistics_company"]
-        return self._logistics_company[_id]
+            if err:
+                raise PddApiError("%s: %s" % (api_name, err))
+            result = result["logistics_companies_get_response"]["logistics_companies"]
+            logistics_company = {str(i["id"]): i["logistics_company"] for i in result}
+            self._cache.set("logistics_company", logistics_company, self._logistics_company_ttl)
+        return logistics_company[str(_id)]
 
     async def get_order_status(self, order_sns):
         """
@@ -133,11 +238,15 @@ class Pdd:
 
     async def get_logistics_address(self):
         # 获取拼多多标准地址库
+        result = self._cache.get("logistics_address")
+        if result:
+            return result, None
         api_name = "pdd.logistics.address.get"
         data = self.get_common_params(api_name)
         result, err = await self.send_post(data)
         if not err:
             result = result["logistics_address_get_response"]["logistics_address_list"]
+            self._cache.set("logistics_address", result, self._logistics_address_ttl)
         return result, err
 
     async def get_order_info(self, order_sn):
@@ -247,34 +356,162 @@ class Pdd:
             result = result["refund_increment_get_response"]
         return result, err
 
+    async def iter_pages(self, method, list_key, *args, page_size=100, prefetch=1, reverse=True, use_has_next=False,
+                         **kwargs):
+        """
+        逐页返回分页接口的数据列表, 处理当前页的同时预先请求后面 prefetch 页, 内存中最多保留 prefetch + 1 页
+        按第一页的 total_count 确定页数, 只有一页时不再发其他请求; 默认从最后一页往前翻页(避免漏单), 最后重新获取第一页;
+        reverse=False 时从第二页往后翻页, 不重新获取第一页, 只适合查询结果在翻页过程中不会变化的场景(如按成交时间查询),
+        请求数等于页数;
+        use_has_next 时按 has_next 从前往后翻页, 不知道总页数, 不预先请求, 逐页顺序请求
+        :param method:          分页接口, 如 self.get_order_list_increment
+        :param list_key:        结果中的列表字段, 如 "order_sn_list"
+        :param args:            分页接口的位置参数(开始/结束时间)
+        :param page_size:       每页数量, 最大 100
+        :param prefetch:        预先请求的页数
+        :param reverse:         是否从最后一页往前翻页
+        :param use_has_next:    是否使用 has_next 的分页方式
+        :param kwargs:          分页接口的其他参数
+        :return:
+        """
+        if use_has_next:
+            kwargs["use_has_next"] = True
+            prefetch = 0  # 预先请求的页在最后一页之后会白白消耗限流令牌
+
+        async def fetch(page):
+            result, err = await method(*args, page=page, page_size=page_size, **kwargs)
+            if err:
+                raise PddApiError("%s 第%d页: %s" % (list_key, page, err))
+            PAGES.inc(list_key=list_key)
+            RECORDS.inc(len(result.get(list_key) or ()), list_key=list_key)
+            return result
+
+        result = await fetch(1)
+        if use_has_next:
+            yield result[list_key]
+            if not result.get("has_next"):
+                return
+            pages = count(2)
+        else:
+            total_page = get_total_page(result["total_count"], page_size)
+            if total_page <= 1:
+                yield result[list_key]
+                return
+            if reverse:
+                # 第一页的数据在往后翻页的过程中可能发生偏移, 最后重新获取
+                pages = iter(range(total_page, 0, -1))
+            else:
+                yield result[list_key]
+                pages = iter(range(2, total_page + 1))
+
+        tasks = deque()
+        try:
+            for page in pages:
+                tasks.append(asyncio.ensure_future(fetch(page)))
+                if len(tasks) <= prefetch:
+                    continue
+                result = await tasks.popleft()
+                yield result[list_key]
+                if use_has_next and not result.get("has_next"):
+                    return
+            while tasks:
+                result = await tasks.popleft()
+                yield result[list_key]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def iter_order_list(self, start_confirm_at: int, end_confirm_at: int, **kwargs):
+        """逐条返回 get_order_list 的订单, 参数同 iter_pages"""
+        async for page in self.iter_pages(
+                self.get_order_list, "order_list", start_confirm_at, end_confirm_at, **kwargs):
+            for order in page:
+                yield order
+
+    async def iter_order_list_increment(self, start_updated_at: int, end_updated_at: int, **kwargs):
+        """逐条返回 get_order_list_increment 的订单, 参数同 iter_pages"""
+        async for page in self.iter_pages(
+                self.get_order_list_increment, "order_sn_list", start_updated_at, end_updated_at, **kwargs):
+            for order in page:
+                yield order
+
+    async def iter_refund_list_increment(self, start_updated_at: int, end_updated_at: int, **kwargs):
+        """逐条返回 get_refund_list_increment 的售后单, 参数同 iter_pages"""
+        async for page in self.iter_pages(
+                self.get_refund_list_increment, "refund_list", start_updated_at, end_updated_at, **kwargs):
+            for refund in page:
+                yield refund
+
 
-def get_sign(params: dict):
-    sorted_dict = sorted(params.items())
-    text = "".join([''.join((str(k), str(v))) for k, v in sorted_dict])
-    text = "{client_secret}{text}{client_secret}".format(client_secret=CLIENT_SECRET, text=text)
-    return md5(text.encode("utf-8")).hexdigest().upper()
+def get_total_page(total_count, page_size=100):
+    return (total_count + page_size - 1) // page_size
+
+
+class Signer:
+    """
+    拼多多请求签名: md5(client_secret + 按参数名排序拼接的 参数名参数值 + client_secret) 转大写
+    每个应用创建一次, client_secret 前缀的 md5 状态只计算一次, 每次签名复制后继续计算
+    """
+    __slots__ = ("_prefix", "_suffix")
+
+    def __init__(self, client_secret):
+        self._suffix = client_secret.encode("utf-8")
+        self._prefix = md5(self._suffix)
+
+    def sign(self, params: dict):
+        hasher = self._prefix.copy()
+        hasher.update("".join([k + str(params[k]) for k in sorted(params)]).encode("utf-8"))
+        hasher.update(self._suffix)
+        return hasher.hexdigest().upper()
+
+
+def get_sign(params: dict, client_secret):
+    """单次签名, 同一个应用多次签名时使用 Signer"""
+    return Signer(client_secret).sign(params)
 
 
 def get_current_timestamp():
     return int(datetime.now().timestamp())
 
 
-async def send_pdd_request(method, url, headers=None, data=None, params=None, json=None):
+def create_client_session(limit=100, limit_per_host=30, ttl_dns_cache=300, keepalive_timeout=60, timeout=30):
+    """
+    创建长连接的 aiohttp.ClientSession, 同一个连接池可以在多个店铺的 Pdd 实例之间共用
+    :param limit:               连接池总连接数
+    :param limit_per_host:      单个 host 的最大连接数
+    :param ttl_dns_cache:       DNS 缓存时间(秒)
+    :param keepalive_timeout:   空闲连接保活时间(秒)
+    :param timeout:             单次请求总超时时间(秒)
+    :return:
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=ttl_dns_cache,
+        keepalive_timeout=keepalive_timeout,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+async def _request_json(session, method, url, headers, data, params, json):
+    # 直接解析响应字节, 省去先解码成 str 的一次复制
+    async with session.request(method, url, params=params, data=data, headers=headers, json=json) as response:
+        return json_loads(await response.read())
+
+
+async def send_pdd_request(method, url, headers=None, data=None, params=None, json=None, session=None):
     result = err = None
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.request(method, url, params=params, data=data, headers=headers, json=json) as response:
-                result = await response.json(encoding="utf-8")
+        if session is None:
+            async with aiohttp.ClientSession() as tmp_session:
+                result = await _request_json(tmp_session, method, url, headers, data, params, json)
+        else:
+            result = await _request_json(session, method, url, headers, data, params, json)
     except Exception as e:
         err = str(e)
         return result, err
 
     if result and result.get("error_response"):
         err = result["error_response"]
-        error_code = result["error_response"]["error_code"]
-        if error_code in {52101, 52102, 52103, 70031}:  # 当前接口被限流/接口暂时不可用/服务暂时不可用/调用过于频繁
-            print("拼多多接口限流, 稍后重试... %s" % err)
-            await asyncio.sleep(0.2)
-            return await send_pdd_request(method, url, headers=headers, data=data, params=params, json=json)
         result = None
     return result, err
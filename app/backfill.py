@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import datetime
+import time
+import traceback
+from app import settings
+from app.pdd import PAGE_CONCURRENCY, create_pipeline, enrich_refunds, finish_window, limiter, refund_cache, \
+    registry, run_malls, to_db, write_metrics
+from app.writer import to_records
+from datetime import timedelta, datetime as dt
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from logger import get_logger
+from models.pdd import BackfillShard, dispose_engines
+
+
+"""
+按成交时间回补历史订单, 时间范围按 (店铺, 天或更短的时间段) 切成分片, 多个 worker 并发执行
+接口总 QPS 由 limiter 的 PDD_TOTAL_QPS 约束; 每个分片写完后记录到 backfill_shard, 中断后用同一个 run_key 重新运行会跳过已完成的分片
+
+    python -m app.backfill --days 90
+    python -m app.backfill --begin 2026-07-01 --end 2026-09-30 --run-key schema-v5 --workers 16
+"""
+
+logger = get_logger("pdd_backfill")
+BACKFILL_WORKERS = getattr(settings, "BACKFILL_WORKERS", 8)
+BACKFILL_SHARD_HOURS = getattr(settings, "BACKFILL_SHARD_HOURS", 24)
+
+
+async def backfill(days_before=None, begin_date=None, end_date=None, run_key=None, shard_hours=None, workers=None):
+    """
+    回补 begin_date ~ end_date(含)的订单, 或最近 days_before 天(含当天)的订单
+    :param run_key:     回补标识, 默认按日期范围生成; 相同 run_key 的已完成分片不再执行
+    :param shard_hours: 每个分片的小时数, 默认 BACKFILL_SHARD_HOURS
+    :param workers:     同时执行的分片数, 默认 BACKFILL_WORKERS
+    """
+    if days_before is not None:
+        end_date = dt.now().date()
+        begin_date = end_date - timedelta(days=days_before)
+    if run_key is None:
+        run_key = "confirm:%s:%s" % (begin_date, end_date)
+    shard_hours = shard_hours or BACKFILL_SHARD_HOURS
+    workers = workers or BACKFILL_WORKERS
+
+    refund_cache.clear()
+    async with create_pipeline() as pipeline:
+        malls = await registry.get_malls(pipeline)
+        done = await pipeline.run(get_done_shards, run_key)
+        shards = [
+            (mall_obj, begin, end)
+            for begin, end in get_shards(begin_date, end_date, shard_hours)
+            for mall_obj in malls
+            if done.get((mall_obj.id, begin), -1) < end
+        ]
+        logger.info("回补%s: 店铺%d个, 待执行分片%d个, 已完成分片%d个" % (run_key, len(malls), len(shards), len(done)))
+        if not shards:
+            return
+
+        queue = asyncio.Queue()
+        for shard in shards:
+            queue.put_nowait(shard)
+        progress = Progress(len(shards))
+        await asyncio.gather(*[run_worker(queue, pipeline, run_key, progress) for _ in range(workers)])
+        # 分片完成时不查询售后单, 全部分片结束后每个店铺查询一次, 避免多个分片重复查询同一批订单
+        shard_malls = {mall_obj.id: mall_obj for mall_obj, _, _ in shards}
+        await run_malls(list(shard_malls.values()), lambda mall_obj: enrich_refunds(
+            pipeline, registry.get_client(mall_obj), mall_obj.id))
+    logger.info("回补%s完成: 成功分片%d个, 失败分片%d个, 订单%d条, 耗时%.0f秒" % (
+        run_key, progress.done, progress.failed, progress.orders, time.monotonic() - progress.started))
+    logger.info("拼多多接口限流统计: %s" % limiter.stats())
+    write_metrics()
+
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.orders = 0
+        self.started = time.monotonic()
+
+    def update(self, order_count=0, failed=False):
+        if failed:
+            self.failed += 1
+        else:
+            self.done += 1
+            self.orders += order_count
+        finished = self.done + self.failed
+        elapsed = time.monotonic() - self.started
+        eta = elapsed / finished * (self.total - finished)
+        logger.info("回补进度 %d/%d, 订单%d条, 已用%.0f秒, 预计剩余%.0f秒" % (
+            finished, self.total, self.orders, elapsed, eta))
+
+
+async def run_worker(queue, pipeline, run_key, progress):
+    """
+    依次从队列中取分片执行, 分片的订单页放进写库队列后不等写完就取下一个分片
+    单个分片失败只记录日志, 不记录完成, 下次运行时重试
+    """
+    pending = []
+
+    async def finish(mall_obj, begin, end, futures):
+        pdd = registry.get_client(mall_obj)
+        try:
+            total_count = await finish_window(
+                pipeline, pdd, mall_obj, begin, end, futures,
+                checkpoint=(save_shard, run_key, mall_obj.id, begin, end), with_refunds=False)
+        except Exception as e:
+            logger.error("回补分片%s %s -> %s失败: %s \n %s" % (
+                mall_obj.erp_name, begin, end, e, traceback.format_exc()))
+            progress.update(failed=True)
+        else:
+            progress.update(total_count)
+
+    while not queue.empty():
+        mall_obj, begin, end = queue.get_nowait()
+        pdd = registry.get_client(mall_obj)
+        futures = []
+        try:
+            # 成交时间不会变化, 按总数从前往后翻页, 不重新获取第一页, 每页只请求一次
+            async for order_list in pdd.iter_pages(
+                    pdd.get_order_list, "order_list", begin, end, prefetch=PAGE_CONCURRENCY, reverse=False):
+                futures.append(await pipeline.submit(to_db, to_records(order_list), mall_obj.id))
+        except Exception as e:
+            logger.error("回补分片%s %s -> %s拉取失败: %s \n %s" % (
+                mall_obj.erp_name, begin, end, e, traceback.format_exc()))
+            await asyncio.gather(*futures, return_exceptions=True)
+            progress.update(failed=True)
+            continue
+        pending.append(asyncio.ensure_future(finish(mall_obj, begin, end, futures)))
+    await asyncio.gather(*pending)
+
+
+def get_shards(begin_date, end_date, shard_hours=24, now=None):
+    """
+    begin_date ~ end_date(含)按 shard_hours 切分的时间段, 每天单独切分, 不跨天; 结束时间不超过当前时间
+    :return: [(begin, end)]
+    """
+    if now is None:
+        now = dt.now().timestamp()
+    shards = []
+    day = begin_date
+    while day <= end_date:
+        day_begin = dt.combine(day, datetime.time.min)
+        day_end = int(dt.combine(day, datetime.time.max).timestamp())
+        for hour in range(0, 24, shard_hours):
+            begin = int((day_begin + timedelta(hours=hour)).timestamp())
+            if begin > now:
+                break
+            end = min(int((day_begin + timedelta(hours=hour + shard_hours)).timestamp()) - 1, day_end, int(now))
+            shards.append((begin, end))
+        day += timedelta(days=1)
+    return shards
+
+
+def get_done_shards(session, run_key):
+    """:return: {(mall_id, begin_ts): end_ts}"""
+    rows = session.query(BackfillShard.mall_id, BackfillShard.begin_ts, BackfillShard.end_ts).filter(
+        BackfillShard.run_key == run_key, BackfillShard.done_at.isnot(None)).all()
+    return {(row.mall_id, row.begin_ts): row.end_ts for row in rows}
+
+
+def save_shard(session, run_key, mall_id, begin_ts, end_ts, total_count, created_count, updated_count,
+               unchanged_count=0):
+    values = {
+        "run_key": run_key,
+        "mall_id": mall_id,
+        "begin_ts": begin_ts,
+        "end_ts": end_ts,
+        "total_count": total_count,
+        "created_count": created_count,
+        "updated_count": updated_count,
+        "unchanged_count": unchanged_count,
+        "done_at": dt.now(),
+    }
+    stmt = pg_insert(BackfillShard).values(**values)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[BackfillShard.run_key, BackfillShard.mall_id, BackfillShard.begin_ts],
+        set_={key: stmt.excluded[key] for key in values if key not in ("run_key", "mall_id", "begin_ts")},
+    ))
+
+
+async def main(args):
+    try:
+        await backfill(
+            days_before=args.days,
+            begin_date=args.begin,
+            end_date=args.end,
+            run_key=args.run_key,
+            shard_hours=args.shard_hours,
+            workers=args.workers,
+        )
+    finally:
+        await registry.close()
+        await dispose_engines()
+
+
+def parse_args(argv=None):
+    def to_date(value):
+        return dt.strptime(value, "%Y-%m-%d").date()
+
+    parser = argparse.ArgumentParser(description="按成交时间回补拼多多订单")
+    parser.add_argument("--days", type=int, help="回补最近 N 天(含当天)")
+    parser.add_argument("--begin", type=to_date, help="开始日期 YYYY-MM-DD")
+    parser.add_argument("--end", type=to_date, help="结束日期 YYYY-MM-DD, 默认当天")
+    parser.add_argument("--run-key", help="回补标识, 中断后使用相同的标识继续")
+    parser.add_argument("--shard-hours", type=int, choices=(1, 2, 3, 4, 6, 8, 12, 24), help="每个分片的小时数")
+    parser.add_argument("--workers", type=int, help="同时执行的分片数")
+    args = parser.parse_args(argv)
+    if args.days is None and args.begin is None:
+        parser.error("需要 --days 或 --begin")
+    if args.begin is not None and args.end is None:
+        args.end = dt.now().date()
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,117 @@
+import asyncio
+import signal
+import time
+import traceback
+from aiohttp import web
+from app import settings
+from app.pdd import registry, sync_by_confirm_time_, sync_by_update_time_, sync_privacy_info_, write_metrics
+from app.reconcile import reconcile_orders_
+from app.refund import sync_refunds_
+from api.metrics import default_registry
+from logger import get_logger
+from models.pdd import dispose_engines
+
+
+"""
+常驻进程, 在同一个事件循环中定时执行同步任务, 数据库连接池和每个店铺的 HTTP 连接池一直保持
+
+    python -m app.daemon
+
+配置 METRICS_PORT 时在 http://0.0.0.0:METRICS_PORT/metrics 提供 Prometheus 指标
+"""
+
+logger = get_logger("pdd_daemon")
+
+
+class Job:
+    """
+    定时任务, 上一次执行结束后才会开始下一次, 同一个任务不会重叠执行
+    :param name:        任务名称
+    :param func:        async func(*args)
+    :param interval:    两次开始执行之间的间隔(秒), 执行时间超过间隔时结束后立即开始下一次
+    """
+
+    def __init__(self, name, func, interval, *args):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.args = args
+
+
+class Daemon:
+    """
+    :param jobs:            定时任务列表
+    :param metrics_port:    提供 /metrics 的端口, 不传则不启动
+    """
+
+    def __init__(self, jobs, metrics_port=None):
+        self.jobs = jobs
+        self.metrics_port = metrics_port
+        self._stop = None
+
+    def stop(self):
+        if not self._stop.is_set():
+            logger.info("收到退出信号, 等待正在执行的任务完成...")
+            self._stop.set()
+
+    async def run(self):
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:  # windows
+                pass
+        runner = await self._start_metrics_server() if self.metrics_port else None
+        try:
+            await asyncio.gather(*[self._run_job(job) for job in self.jobs])
+        finally:
+            if runner is not None:
+                await runner.cleanup()
+            await registry.close()
+            await dispose_engines()
+            logger.info("常驻进程已退出")
+
+    async def _run_job(self, job):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                await job.func(*job.args)
+            except Exception as e:
+                logger.error("定时任务%s执行失败: %s \n %s" % (job.name, e, traceback.format_exc()))
+            else:
+                logger.info("定时任务%s执行完成, 耗时%.1f秒" % (job.name, time.monotonic() - started))
+            write_metrics()
+            wait = job.interval - (time.monotonic() - started)
+            try:
+                await asyncio.wait_for(self._stop.wait(), max(wait, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _start_metrics_server(self):
+        async def handle(request):
+            return web.Response(text=default_registry.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, port=self.metrics_port).start()
+        logger.info("指标地址 http://0.0.0.0:%d/metrics" % self.metrics_port)
+        return runner
+
+
+def get_jobs():
+    return [
+        # 售后信息由 sync_refunds 按售后单增量同步, 订单同步不再逐个查询售后单
+        Job("sync_by_update_time", sync_by_update_time_, getattr(settings, "DAEMON_UPDATE_INTERVAL", 300), False, False),
+        Job("sync_refunds", sync_refunds_, getattr(settings, "DAEMON_REFUND_INTERVAL", 300)),
+        Job("sync_by_confirm_time", sync_by_confirm_time_, getattr(settings, "DAEMON_CONFIRM_INTERVAL", 86400),
+            getattr(settings, "DAEMON_CONFIRM_DAYS", 3)),
+        Job("sync_privacy_info", sync_privacy_info_, getattr(settings, "DAEMON_PRIVACY_INTERVAL", 600)),
+        Job("reconcile_orders", reconcile_orders_, getattr(settings, "DAEMON_RECONCILE_INTERVAL", 1800)),
+    ]
+
+
+if __name__ == "__main__":
+    asyncio.run(Daemon(get_jobs(), getattr(settings, "METRICS_PORT", None)).run())
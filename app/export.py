@@ -0,0 +1,177 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+import uuid
+from datetime import timedelta, datetime as dt
+from itertools import groupby
+
+from sqlalchemy import BigInteger, Boolean, DateTime, Integer, Numeric, func, select
+from sqlalchemy.dialects.postgresql import UUID
+
+from logger import get_logger
+from models.pdd import Item, Order, engine
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # 没有安装 pyarrow 时导出为 csv.gz
+    pyarrow = None
+
+
+"""
+导出订单和明细供分析使用, 服务端游标按 chunk_size 分块读取, 内存占用与表大小无关
+按 店铺/成交日期 分区写入 Parquet(需要 pyarrow) 或 csv.gz:
+
+    {out}/order/mall_id=1/date=2026-10-01/part-20261018T120000.parquet
+    {out}/item/mall_id=1/date=2026-10-01/part-20261018T120000.parquet
+
+增量导出只导出 updated_at 在上次导出之后的订单(及其明细), 进度保存在 {out}/_watermark.json;
+同一订单可能出现在多次导出的文件中, 使用时按 id 取 updated_at 最新的一条
+
+    python -m app.export --out /data/pdd_export
+"""
+
+logger = get_logger("pdd_export")
+WATERMARK_FILE = "_watermark.json"
+# 订单在事务开始时写入 updated_at, 提交可能稍晚, 只导出 EXPORT_LAG 秒之前的修改, 避免漏掉还没提交的订单
+EXPORT_LAG = 300
+
+ORDER_COLUMNS = [c for c in Order.__table__.c]
+ITEM_COLUMNS = [c for c in Item.__table__.c] + [Order.mall_id, Order.confirm_time]
+
+
+def export(out_dir, chunk_size=10000, file_format=None, full=False, lag=EXPORT_LAG):
+    """
+    :param out_dir:     导出目录
+    :param chunk_size:  每次从游标读取的行数
+    :param file_format: parquet / csv, 默认安装了 pyarrow 时为 parquet
+    :param full:        忽略上次的进度, 导出全部订单
+    :param lag:         只导出 lag 秒之前修改的订单
+    :return: (订单数, 明细数)
+    """
+    file_format = file_format or ("parquet" if pyarrow is not None else "csv")
+    if file_format == "parquet" and pyarrow is None:
+        raise RuntimeError("导出 parquet 需要安装 pyarrow")
+    os.makedirs(out_dir, exist_ok=True)
+    since = None if full else read_watermark(out_dir)
+    with engine.connect() as conn:
+        until = conn.execute(select(func.localtimestamp())).scalar() - timedelta(seconds=lag)
+    part_name = "part-%s" % until.strftime("%Y%m%dT%H%M%S")
+
+    changed = Order.updated_at <= until
+    if since is not None:
+        changed = changed & (Order.updated_at > since)
+    order_query = select(*ORDER_COLUMNS).where(changed).order_by(Order.mall_id, Order.confirm_time)
+    item_query = select(*ITEM_COLUMNS).join(Order, Item.order_id == Order.id).where(changed).order_by(
+        Order.mall_id, Order.confirm_time)
+
+    order_count = export_query(order_query, ORDER_COLUMNS, os.path.join(out_dir, "order"), part_name, chunk_size,
+                               file_format)
+    item_count = export_query(item_query, ITEM_COLUMNS, os.path.join(out_dir, "item"), part_name, chunk_size,
+                              file_format)
+    write_watermark(out_dir, until)
+    logger.info("导出 %s -> %s 的修改: 订单%d条, 明细%d条" % (since, until, order_count, item_count))
+    return order_count, item_count
+
+
+def export_query(query, columns, out_dir, part_name, chunk_size, file_format):
+    """查询按 (mall_id, confirm_time) 排序, 同一分区的行是连续的, 同一时间只打开一个分区文件"""
+    writer_cls = ParquetPartWriter if file_format == "parquet" else CsvPartWriter
+    writer = None
+    key = None
+    count = 0
+    with engine.connect().execution_options(stream_results=True, yield_per=chunk_size) as conn:
+        for chunk in conn.execute(query).partitions():
+            for partition, rows in groupby(chunk, key=get_partition):
+                if partition != key:
+                    if writer is not None:
+                        writer.close()
+                    key = partition
+                    writer = writer_cls(
+                        os.path.join(out_dir, "mall_id=%s" % partition[0], "date=%s" % partition[1]), part_name,
+                        columns)
+                rows = list(rows)
+                writer.write(rows)
+                count += len(rows)
+    if writer is not None:
+        writer.close()
+    return count
+
+
+def get_partition(row):
+    confirm_time = row.confirm_time
+    return row.mall_id, confirm_time.date().isoformat() if confirm_time is not None else "unknown"
+
+
+class CsvPartWriter:
+    def __init__(self, directory, part_name, columns):
+        os.makedirs(directory, exist_ok=True)
+        self._file = gzip.open(os.path.join(directory, part_name + ".csv.gz"), "wt", encoding="utf-8", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([c.name for c in columns])
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetPartWriter:
+    def __init__(self, directory, part_name, columns):
+        os.makedirs(directory, exist_ok=True)
+        self._uuid_columns = [i for i, c in enumerate(columns) if isinstance(c.type, UUID)]
+        self._schema = pyarrow.schema([(c.name, get_arrow_type(c.type)) for c in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(os.path.join(directory, part_name + ".parquet"), self._schema)
+
+    def write(self, rows):
+        data = [list(values) for values in zip(*rows)]
+        for i in self._uuid_columns:
+            data[i] = [str(v) if isinstance(v, uuid.UUID) else v for v in data[i]]
+        self._writer.write_table(pyarrow.Table.from_arrays(data, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def get_arrow_type(sql_type):
+    if isinstance(sql_type, BigInteger):
+        return pyarrow.int64()
+    if isinstance(sql_type, Integer):
+        return pyarrow.int32()
+    if isinstance(sql_type, Numeric):
+        return pyarrow.decimal128(sql_type.precision or 38, sql_type.scale or 0)
+    if isinstance(sql_type, DateTime):
+        return pyarrow.timestamp("us")
+    if isinstance(sql_type, Boolean):
+        return pyarrow.bool_()
+    return pyarrow.string()
+
+
+def read_watermark(out_dir):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return dt.fromisoformat(json.load(f)["updated_at"])
+
+
+def write_watermark(out_dir, updated_at):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"updated_at": updated_at.isoformat()}, f)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="导出拼多多订单和明细")
+    parser.add_argument("--out", required=True, help="导出目录")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--format", choices=("parquet", "csv"), help="默认安装了 pyarrow 时为 parquet")
+    parser.add_argument("--full", action="store_true", help="忽略上次的进度, 导出全部订单")
+    parser.add_argument("--lag", type=int, default=EXPORT_LAG, help="只导出多少秒之前修改的订单")
+    args = parser.parse_args()
+    export(args.out, args.chunk_size, args.format, args.full, args.lag)
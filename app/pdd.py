@@ -1,288 +1,414 @@
 import asyncio
 import datetime
+import functools
+import time
 import traceback
 from app import settings
 from api.erp321 import Erp321
 from api.jdy_v5 import JdyV5
-from api.pdd import Pdd
+from api.cache import TTLCache
+from api.limiter import RateLimiter
+from api.metrics import default_registry
+from app.pipeline import WritePipeline
+from app.registry import MallRegistry
 from app.utils import err_handler
+from app.writer import to_records, upsert_orders, update_orders, update_refunds
 from datetime import timedelta, datetime as dt
+from sqlalchemy import or_
 from logger import get_logger
-from models.pdd import Session, Monitor, Order, Item, Mall
+from models.pdd import Monitor, Order
 
 
 """
 定时任务执行, 同步拼多多订单到本地数据库
 """
 
-mall_objs = Session().query(Mall).filter_by(active=True).all()
 logger = get_logger("pdd")
-counter = {}
+limiter = RateLimiter(
+    rate=getattr(settings, "PDD_QPS", 10),
+    burst=getattr(settings, "PDD_BURST", 10),
+    overrides=getattr(settings, "PDD_API_QPS", None),
+    total_rate=getattr(settings, "PDD_TOTAL_QPS", None),
+)
+PAGE_CONCURRENCY = getattr(settings, "PDD_PAGE_CONCURRENCY", 4)
+MALL_CONCURRENCY = getattr(settings, "PDD_MALL_CONCURRENCY", 4)
+REFUND_CONCURRENCY = getattr(settings, "PDD_REFUND_CONCURRENCY", 5)
+PRIVACY_CONCURRENCY = getattr(settings, "PRIVACY_CONCURRENCY", 3)
+PRIVACY_BATCH_SIZE = 20  # 聚水潭每次最多查询 20 个订单
+INITIAL_DAYS = getattr(settings, "PDD_INITIAL_DAYS", 1)  # 没有同步进度的店铺(新接入的店铺)从几天前开始同步
+# 物流公司/地址库/店铺信息, 配置 PDD_CACHE_PATH 后保存到本地 SQLite, 进程重启和多个进程之间共用
+reference_cache = TTLCache(
+    maxsize=getattr(settings, "PDD_CACHE_SIZE", 256),
+    path=getattr(settings, "PDD_CACHE_PATH", None),
+)
+registry = MallRegistry(ttl=getattr(settings, "MALL_REGISTRY_TTL", 300), limiter=limiter, cache=reference_cache)
+refund_cache = {}  # 售后单详情 {so_no: refund_info}, 每次同步开始时清空
+refund_lookups = {}  # 正在查询的售后单详情 {so_no: future}, 多个窗口/分片同时查询同一订单时共用一次请求
+METRICS_PATH = getattr(settings, "METRICS_PATH", None)  # 每次同步结束后把指标写入此文件
+
+SYNC_LAG = default_registry.gauge("pdd_sync_lag_seconds", "店铺增量同步进度(Monitor.last_run_ts)落后当前时间的秒数", ["mall_id"])
+WINDOWS = default_registry.counter("pdd_sync_windows_total", "写完并提交进度的同步窗口/回补分片数")
+ORDERS = default_registry.counter("pdd_orders_total", "入库的订单数, result 为 created/updated/unchanged", ["result"])
+
+
+async def sync_by_update_time_(with_privacy=True, with_refunds=True):
+    """
+    :param with_privacy:    同步完成后是否补充收货人信息, 常驻进程中补充收货人信息是单独的任务
+    :param with_refunds:    是否逐个查询退款成功订单的售后单, 常驻进程中由 app.refund 按售后单增量同步
+    """
+    refund_cache.clear()
+    async with create_pipeline() as pipeline:
+        malls = await registry.get_malls(pipeline)
+        await run_malls(malls, lambda mall_obj: sync_mall_by_update_time(mall_obj, pipeline, with_refunds))
+    logger.info("拼多多接口限流统计: %s" % limiter.stats())
+    if with_privacy:
+        await sync_privacy_info_()
+    write_metrics()
+
+
+async def sync_mall_by_update_time(mall_obj, pipeline, with_refunds=True):
+    """
+    从上次的同步进度追到 拼多多当前时间 - 3min, 每个 30 分钟窗口的订单写完后提交一次进度
+    订单页拉到后直接放进写库队列, 不等写库完成就继续拉下一页/下一个窗口, 进度严格按窗口先后顺序提交
+    """
+    pdd = registry.get_client(mall_obj)
+    last_run_ts = await pipeline.run(get_last_run_ts, mall_obj.id)
+    if last_run_ts is None:
+        last_run_ts = int((dt.now() - timedelta(days=INITIAL_DAYS)).timestamp())
+    SYNC_LAG.set(int(time.time()) - last_run_ts, mall_id=mall_obj.id)
+    windows = get_pending_windows(last_run_ts)
+    if len(windows) > 1:
+        logger.info("%s 同步进度落后, 待追赶窗口%d个" % (mall_obj.erp_name, len(windows)))
+
+    async def fetch(begin, end, futures):
+        async for order_list in pdd.iter_pages(
+                pdd.get_order_list_increment, "order_sn_list", begin, end, prefetch=PAGE_CONCURRENCY):
+            futures.append(await pipeline.submit(to_db, to_records(order_list), mall_obj.id))
+
+    await run_windows(windows, fetch, functools.partial(
+        finish_window, pipeline, pdd, mall_obj, with_refunds=with_refunds))
+
+
+async def run_windows(windows, fetch, finish):
+    """
+    依次拉取各窗口, 窗口的页放进写库队列后不等写完就拉下一个窗口, 由 finish 按窗口先后顺序提交进度
+    有窗口写库失败后不再拉取后面的窗口; 拉取失败时, 已经拉完的窗口照常写完并提交进度, 然后抛出异常
+    :param windows: [(begin, end)]
+    :param fetch:   async (begin, end, futures) -> None, 把窗口内各页的写库任务追加到 futures
+    :param finish:  async (begin, end, futures, previous) -> None, previous 为上一个窗口的 finish
+    """
+    failed = []
+    finishing = []
+    futures = []
+
+    def on_done(future):
+        if not future.cancelled() and future.exception() is not None:
+            failed.append(future)
+
+    try:
+        for begin, end in windows:
+            if failed:
+                break
+            futures = []
+            await fetch(begin, end, futures)
+            previous = asyncio.ensure_future(finish(begin, end, futures, finishing[-1] if finishing else None))
+            previous.add_done_callback(on_done)
+            finishing.append(previous)
+    except asyncio.CancelledError:
+        for future in finishing:
+            future.cancel()
+        raise
+    except Exception:
+        await asyncio.gather(*futures, *finishing, return_exceptions=True)
+        raise
+    # 后面的窗口会抛出与第一个失败的窗口相同的异常, 全部取回后抛出第一个
+    for result in await asyncio.gather(*finishing, return_exceptions=True):
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def finish_window(pipeline, pdd, mall_obj, begin, end, futures, previous=None, checkpoint=None,
+                        with_refunds=True):
+    """
+    等窗口内的订单全部写完后提交进度, 然后补充售后信息; previous 为上一个窗口, 保证进度按顺序提交
+    :param checkpoint:      提交进度的写库任务 (fn, *args), 执行时在参数后面追加各项计数, 默认写入 Monitor
+    :param with_refunds:    是否查询退款成功订单的售后单
+    :return: 窗口内的订单数
+    """
+    is_monitor = checkpoint is None
+    if is_monitor:
+        checkpoint = (save_monitor, mall_obj.id, end)
+    results = await gather_window(futures, previous)
+    total_count = created_count = updated_count = unchanged_count = 0
+    for page_count, created, updated, unchanged in results:
+        total_count += page_count
+        created_count += created
+        updated_count += updated
+        unchanged_count += unchanged
+    await pipeline.run(*checkpoint, total_count, created_count, updated_count, unchanged_count)
+    WINDOWS.inc()
+    ORDERS.inc(created_count, result="created")
+    ORDERS.inc(updated_count, result="updated")
+    ORDERS.inc(unchanged_count, result="unchanged")
+    if is_monitor:
+        SYNC_LAG.set(int(time.time()) - end, mall_id=mall_obj.id)
+    logger.info(
+        "%s %s -> %s 运行完毕, 拼多多数据记录%s, 新增%s, 修改%s, 没有变化%s"
+        % (mall_obj.erp_name, begin, end, total_count, created_count, updated_count, unchanged_count)
+    )
+    if with_refunds:
+        await enrich_refunds(pipeline, pdd, mall_obj.id)
+    return total_count
+
+
+async def gather_window(futures, previous=None):
+    """
+    等窗口内的写库任务全部完成, 再等上一个窗口提交进度, 之后才能提交本窗口的进度
+    先等本窗口写完, 上一个窗口失败时本窗口的写库结果也已经取回
+    :return: 各写库任务的返回值
+    """
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    if previous is not None:
+        await previous
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
 
 
-async def sync_by_update_time_():
-    global counter
-    counter = {}
-    session = Session()
-    for mall_obj in mall_objs:
-        try:
-            logger.info("开始处理%s" % mall_obj.erp_name)
-            counter[mall_obj.id] = {
-                "created_count": 0,
-                "updated_count": 0,
-            }
-
-            pdd = Pdd(mall_obj.client_id, mall_obj.client_secret, mall_obj.token)
-            monitor_obj = session.query(Monitor).filter(
-                Monitor.mall_id == mall_obj.id).order_by(-Monitor.last_run_ts).first()
-
-            begin, end = get_time_range_30m(monitor_obj.last_run_ts)
-            now = int(dt.now().timestamp()) - 30
-            if now > end:
-                last_ts = end
-            else:
-                last_ts = now
-            result, err = await pdd.get_order_list_increment(
-                start_updated_at=begin,
-                end_updated_at=end,
-                page=1,
-                page_size=1,
-            )
-            err_handler("获取拼多多订单数据", err)
-
-            total_count = result["total_count"]
-            logger.info("%s -> %s 获取拼多多数据记录为%s" % (begin, end, total_count))
-
-            if total_count > 0:
-                total_page = int(total_count / 100) + 1
-                tasks = []
-                for page in range(1, total_page + 1):
-                    result, err = await pdd.get_order_list_increment(
-                        start_updated_at=begin,
-                        end_updated_at=end,
-                        page=page,
-                        page_size=100,
-                    )
-                    err_handler("获取拼多多订单数据, 页%d" % page, err)
-                    order_list = result["order_sn_list"]
-                    tasks.append(to_db(session, pdd, order_list, mall_obj))
-
-                await asyncio.gather(*tasks)
-            session.add(get_monitor_obj(mall_obj, last_ts, total_count))
-            logger.info(
-                "%s 运行完毕, 新增%s, 修改%s"
-                % (mall_obj.erp_name, counter[mall_obj.id]["created_count"], counter[mall_obj.id]["updated_count"])
-            )
-        except Exception as e:
-            logger.error("定时任务-电商ERP订单-同步表单: %s \n %s" % (e, traceback.format_exc()))
-        else:
-            session.commit()
-            await sync_privacy_info_()
+async def sync_by_confirm_time_(days_before):
+    """按成交时间回补最近 days_before 天(含当天)的订单, 见 app.backfill"""
+    from app.backfill import backfill  # app.backfill 依赖本模块
+    await backfill(days_before)
 
 
-async def sync_by_confirm_time_(days_before):
-    global counter
-    counter = {}
-    session = Session()
-
-    for d in range(days_before, -1, -1):
-        day = dt.now() - timedelta(days=d)
-        begin, end = get_time_range(day)
-        for mall_obj in mall_objs:
+def write_metrics(path=None):
+    """配置了 METRICS_PATH 时把当前指标写入文件(Prometheus 文本格式)"""
+    path = path or METRICS_PATH
+    if path:
+        try:
+            default_registry.write(path)
+        except OSError as e:
+            logger.warning("写入指标文件%s失败: %s" % (path, e))
+
+
+def create_pipeline():
+    return WritePipeline(
+        maxsize=getattr(settings, "PIPELINE_QUEUE_SIZE", 16),
+        batch_size=getattr(settings, "PIPELINE_BATCH_SIZE", 8),
+    )
+
+
+async def run_malls(malls, job, concurrency=None):
+    """
+    多个店铺并发执行同一个任务, 同时运行的店铺数不超过 concurrency, 按店铺顺序排队(先到先得)
+    单个店铺失败只记录日志, 不影响其他店铺
+    :param malls:       店铺列表
+    :param job:         async (mall_obj) -> None
+    :param concurrency: 并发店铺数, 默认 MALL_CONCURRENCY
+    :return:
+    """
+    sem = asyncio.Semaphore(concurrency or MALL_CONCURRENCY)
+
+    async def run(mall_obj):
+        async with sem:
+            logger.info("开始处理%s" % mall_obj.erp_name)
             try:
-                logger.info("开始处理%s" % mall_obj.erp_name)
-                counter[mall_obj.id] = {
-                    "created_count": 0,
-                    "updated_count": 0,
-                }
-
-                pdd = Pdd(mall_obj.client_id, mall_obj.client_secret, mall_obj.token)
-
-                result, err = await pdd.get_order_list(
-                    start_confirm_at=begin,
-                    end_confirm_at=end,
-                    page=1,
-                    page_size=1,
-                )
-                err_handler("获取拼多多订单数据", err)
-
-                total_count = result["total_count"]
-                logger.info("%s -> %s 获取拼多多数据记录为%s" % (begin, end, total_count))
-
-                if total_count > 0:
-                    total_page = int(total_count / 100) + 1
-                    for page in range(total_page, 0, -1):
-                        result, err = await pdd.get_order_list(
-                            start_confirm_at=begin,
-                            end_confirm_at=end,
-                            page=page,
-                            page_size=100,
-                        )
-                        err_handler("获取拼多多订单数据, 页%d" % page, err)
-                        order_list = result["order_list"]
-                        await to_db(session, pdd, order_list, mall_obj)
-
-                session.add(get_monitor_obj(mall_obj, end, total_count))
-                logger.info(
-                    "%s 运行完毕, 新增%s, 修改%s"
-                    % (mall_obj.erp_name, counter[mall_obj.id]["created_count"], counter[mall_obj.id]["updated_count"])
-                )
+                await job(mall_obj)
             except Exception as e:
-                logger.error("定时任务-电商ERP订单-同步表单: %s \n %s" % (e, traceback.format_exc()))
+                logger.error(
+                    "定时任务-电商ERP订单-同步表单[%s]: %s \n %s" % (mall_obj.erp_name, e, traceback.format_exc()))
+
+    await asyncio.gather(*[run(mall_obj) for mall_obj in malls])
+
+
+def to_db(session, orders, mall_id):
+    """
+    订单入库, 在写库线程中执行, 不提交事务
+    :param orders:  [OrderRecord]
+    :return: (订单数, 新增数, 修改数, 没有变化数)
+    """
+    rows, unchanged = upsert_orders(session, mall_id, orders)
+    created_count = 0
+    for row in rows:
+        if row.inserted:
+            created_count += 1
+    return len(orders), created_count, len(rows) - created_count, len(unchanged)
+
+
+async def resolve_refunds(pdd, so_nos):
+    """
+    并发查询售后单详情, 结果按订单号缓存在 refund_cache 中, 查询失败的订单留到下次同步
+    同一订单正在查询时等待已有的请求, 不重复查询
+    :return: {so_no: refund_info}
+    """
+    sem = asyncio.Semaphore(REFUND_CONCURRENCY)
+
+    async def fetch(so_no):
+        try:
+            async with sem:
+                res, err = await pdd.get_refund_info(so_no)
+            if err:
+                logger.warning("获取售后信息%s失败: %s" % (so_no, err))
             else:
-                session.commit()
-
-
-async def to_db(session, pdd, order_list, mall_obj):
-    for o in order_list:
-        order_data = get_order_data(o)
-        order_data["mall_id"] = mall_obj.id
-
-        order_obj = session.query(Order).filter(Order.so_no == o["order_sn"]).first()
-        if not order_obj:
-            order_obj = Order(**order_data)
-            session.add(order_obj)
-            counter[mall_obj.id]["created_count"] += 1
-        else:
-            session.query(Item).filter(Item.order_id == order_obj.id).delete()
-            for k, v in order_data.items():
-                setattr(order_obj, k, v)
-            counter[mall_obj.id]["updated_count"] += 1
-        session.flush()
-
-        if order_obj.after_sales_status == 10 and order_obj.after_sales_id is None:
-            res, err = await pdd.get_refund_info(order_obj.so_no)
-            err_handler("获取售后信息%s" % order_obj.so_no, err)
-            order_obj.after_sales_id = res["id"]
-            order_obj.after_sales_type = res["after_sales_type"]
-            order_obj.goods_number = res["goods_number"]
-            order_obj.refund_amount = res["refund_amount"] / 100
-
-        item_count = 0
-        for item in o["item_list"]:
-            item_count += 1
-            item_obj = Item(**{
-                "order_id": order_obj.id,
-                "qty": item["goods_count"],
-                "goods_price": item["goods_price"],
-                "goods_name": item["goods_name"],
-                "goods_spec": item["goods_spec"],
-                "goods_id": item["goods_id"],
-                "sku_id": item["sku_id"],
-                "outer_id": item["outer_id"],
+                refund_cache[so_no] = res
+        finally:
+            refund_lookups.pop(so_no, None)
+
+    lookups = []
+    for so_no in set(so_nos):
+        if so_no in refund_cache:
+            continue
+        if so_no not in refund_lookups:
+            refund_lookups[so_no] = asyncio.ensure_future(fetch(so_no))
+        lookups.append(refund_lookups[so_no])
+    await asyncio.gather(*lookups)
+    return {so_no: refund_cache[so_no] for so_no in so_nos if so_no in refund_cache}
+
+
+async def enrich_refunds(pipeline, pdd, mall_id):
+    """
+    订单提交之后再查询售后信息, 避免等待网络时占着事务, 查询结果一次性批量更新
+    待查询的订单从数据库中取, 之前的窗口查询失败的订单在这里重试
+    """
+    refund_candidates = await pipeline.run(get_refund_candidates, mall_id)
+    if not refund_candidates:
+        return
+    refunds = await resolve_refunds(pdd, refund_candidates.values())
+    refund_rows = []
+    for order_id, so_no in refund_candidates.items():
+        res = refunds.get(so_no)
+        if res:
+            refund_rows.append({
+                "id": order_id,
+                "after_sales_id": res["id"],
+                "after_sales_type": res["after_sales_type"],
+                "goods_number": res["goods_number"],
+                "refund_amount": res["refund_amount"] / 100,
             })
-            session.add(item_obj)
-        order_obj.item_count = item_count
-        session.flush()
-
-
-def get_order_data(json_obj):
-    order_data = {
-        "so_no": json_obj["order_sn"],
-        "confirm_time": json_obj["confirm_time"],
-        "so_created_at": json_obj["created_time"],
-        "so_updated_at": json_obj["updated_at"],
-        "confirm_status": json_obj["confirm_status"],
-        "refund_status": json_obj["refund_status"],
-        "after_sales_status": json_obj["after_sales_status"],
-        "order_status": json_obj["order_status"],
-        "risk_control_status": json_obj["risk_control_status"],
-        "goods_amount": json_obj["goods_amount"],
-        "discount_amount": json_obj["discount_amount"],
-        "seller_discount": json_obj["seller_discount"],
-        "platform_discount": json_obj["platform_discount"],
-        "order_change_amount": json_obj["order_change_amount"],
-        "capital_free_discount": json_obj["capital_free_discount"],
-        "pay_amount": json_obj["pay_amount"],
-        "postage": json_obj["postage"],
-        "logistics_id": json_obj["logistics_id"],
-        "tracking_number": json_obj["tracking_number"],
-    }
-    fee = 0.0
-    if json_obj["service_fee_detail"]:
-        for i in json_obj["service_fee"]:
-            fee += i
-    order_data["service_fee"] = fee
-
-    if json_obj["shipping_time"]:
-        order_data["shipping_time"] = json_obj["shipping_time"]
-
-    if json_obj["province"]:
-        order_data["buyer_account"] = json_obj["receiver_phone"]
-        order_data["province"] = json_obj["province"]
-        order_data["city"] = json_obj["city"]
-        order_data["town"] = json_obj["town"]
-
-    return order_data
-
-
-def get_monitor_obj(mall_obj, last_run, total_count):
-    return Monitor(**{
-        "mall_id": mall_obj.id,
-        "last_run_ts": last_run,
-        "last_run_time": datetime.datetime.fromtimestamp(last_run),
-        "total_count": total_count,
-        "created_count": counter[mall_obj.id]["created_count"],
-        "updated_count": counter[mall_obj.id]["updated_count"],
-    })
+    if refund_rows:
+        await pipeline.run(update_refunds, refund_rows)
+
+
+def get_refund_candidates(session, mall_id):
+    """:return: 退款成功但还没有售后单详情的订单 {order_id: so_no}"""
+    rows = session.query(Order.id, Order.so_no).filter(
+        Order.mall_id == mall_id, Order.after_sales_status == 10, Order.after_sales_id.is_(None)).all()
+    return {row.id: row.so_no for row in rows}
 
 
-def get_time_range(date: datetime.datetime):
-    begin = dt.combine(date, datetime.time.min).timestamp()
-    end = dt.combine(date, datetime.time.max).timestamp()
-    now = dt.now().timestamp()
-    if end > now:
-        end = now
-    return int(begin), int(end)
+def get_last_run_ts(session, mall_id):
+    """:return: 店铺最新的同步进度, 没有进度时为 None"""
+    return session.query(Monitor.last_run_ts).filter(
+        Monitor.mall_id == mall_id).order_by(Monitor.last_run_ts.desc()).limit(1).scalar()
 
 
-def get_time_range_30m(begin: int):
-    begin = begin + 1
-    end = begin + (30 * 60) - 1  # 29分59秒
-    now = dt.now().timestamp() + (3 * 60)
-    if end > now:
-        end = now
-    return int(begin), int(end)
+def save_monitor(session, mall_id, last_run, total_count, created_count, updated_count, unchanged_count=0):
+    session.add(Monitor(**{
+        "mall_id": mall_id,
+        "last_run_ts": last_run,
+        "last_run_time": datetime.datetime.fromtimestamp(last_run),
+        "total_count": total_count,
+        "created_count": created_count,
+        "updated_count": updated_count,
+        "unchanged_count": unchanged_count,
+    }))
+
+
+def get_pending_windows(last_run_ts: int, now=None):
+    """
+    上次同步位置到 拼多多当前时间 - 3min 之间所有待同步的窗口, 每个窗口最长 29分59秒
+    :return: [(begin, end)]
+    """
+    if now is None:
+        now = dt.now().timestamp()
+    now = int(now) - (3 * 60)
+    windows = []
+    begin = last_run_ts + 1
+    while begin <= now:
+        end = min(begin + (30 * 60) - 1, now)
+        windows.append((begin, end))
+        begin = end + 1
+    return windows
 
 
 async def sync_privacy_info_():
-    # so_ids最多20条
+    """
+    从聚水潭补充收货人信息, 每次运行按 id 顺序把缺少收货信息的订单过一遍
+    聚水潭每次最多查 20 个订单, 同时请求 PRIVACY_CONCURRENCY 批; 没找到的订单按次数递增推迟下次查询的时间
+    """
     erp = Erp321()
-    session = Session()
-    while True:
-        order_objs = session.query(Order).filter_by(buyer_account=None).limit(20).all()
-        if len(order_objs) > 0:
-            logger.info("db没有收货信息的条数%d" % len(order_objs))
-        else:
-            logger.info("没有需要从聚水潭获取数据的订单")
-            break
-
-        so_ids = [i.so_no for i in order_objs]
-        try:
-            result, err = await erp.get_orders(so_ids=so_ids, page_index=1, page_size=50)
-            err_handler("获取订单数据%s" % so_ids, err)
-
-            for db_obj in order_objs:
-                for o_json in result["orders"]:
-                    if db_obj.so_no == o_json["so_id"]:
-                        if o_json["receiver_mobile"]:
-                            db_obj.buyer_account = o_json["receiver_mobile"]
-                            db_obj.province = o_json["receiver_state"]
-                            db_obj.city = o_json["receiver_city"]
-                            db_obj.town = o_json["receiver_district"]
-                        else:
-                            db_obj.buyer_account = ""
-                            db_obj.province = ""
-                            db_obj.city = ""
-                            db_obj.town = ""
-                        break
-                else:
-                    if not db_obj.buyer_account:
-                        logger.warning("订单%s在聚水潭没有找到" % db_obj.so_no)
-        except Exception as e:
-            logger.error("订单号:%s补充收货人信息: %s \n %s" % (so_ids, e, traceback.format_exc()))
-        else:
-            session.commit()
+    sem = asyncio.Semaphore(PRIVACY_CONCURRENCY)
+
+    async def fetch(so_ids):
+        async with sem:
+            try:
+                result, err = await erp.get_orders(so_ids=so_ids, page_index=1, page_size=50)
+                err_handler("获取订单数据%s" % so_ids, err)
+            except Exception as e:
+                logger.error("订单号:%s补充收货人信息: %s \n %s" % (so_ids, e, traceback.format_exc()))
+                return None
+        return {o_json["so_id"]: o_json for o_json in result["orders"]}
+
+    last_id = None
+    filled_count = missing_count = 0
+    async with create_pipeline() as pipeline:
+        while True:
+            now = dt.now()
+            order_objs = await pipeline.run(
+                get_privacy_candidates, last_id, now, PRIVACY_BATCH_SIZE * PRIVACY_CONCURRENCY)
+            if not order_objs:
+                break
+            last_id = order_objs[-1].id
+
+            batches = [order_objs[k:k + PRIVACY_BATCH_SIZE] for k in range(0, len(order_objs), PRIVACY_BATCH_SIZE)]
+            results = await asyncio.gather(*[fetch([i.so_no for i in batch]) for batch in batches])
+
+            rows = []
+            for batch, found in zip(batches, results):
+                if found is None:  # 请求失败的批次下次运行再查
+                    continue
+                for db_obj in batch:
+                    o_json = found.get(db_obj.so_no)
+                    if o_json is None:
+                        attempts = (db_obj.privacy_attempts or 0) + 1
+                        rows.append({
+                            "id": db_obj.id,
+                            "privacy_attempts": attempts,
+                            "privacy_retry_at": now + get_privacy_retry_delay(attempts),
+                        })
+                        missing_count += 1
+                    elif o_json["receiver_mobile"]:
+                        rows.append({
+                            "id": db_obj.id,
+                            "buyer_account": o_json["receiver_mobile"],
+                            "province": o_json["receiver_state"],
+                            "city": o_json["receiver_city"],
+                            "town": o_json["receiver_district"],
+                        })
+                        filled_count += 1
+                    else:
+                        rows.append({"id": db_obj.id, "buyer_account": "", "province": "", "city": "", "town": ""})
+                        filled_count += 1
+            if rows:
+                await pipeline.run(update_orders, rows)
+    logger.info("补充收货人信息%d条, 聚水潭没有找到%d条" % (filled_count, missing_count))
+
+
+def get_privacy_candidates(session, last_id, now, limit):
+    """按 id 顺序取还没有收货信息、并且到了重试时间的订单"""
+    query = session.query(Order.id, Order.so_no, Order.privacy_attempts).filter(
+        Order.buyer_account.is_(None),
+        or_(Order.privacy_retry_at.is_(None), Order.privacy_retry_at <= now),
+    )
+    if last_id is not None:
+        query = query.filter(Order.id > last_id)
+    return query.order_by(Order.id).limit(limit).all()
+
+
+def get_privacy_retry_delay(attempts):
+    # 1, 2, 4 ... 小时, 最长一天
+    return timedelta(hours=min(2 ** (attempts - 1), 24))
 
 
 def sync_privacy_info():
@@ -300,6 +426,7 @@ def sync_by_confirm_time(days_before):
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.run_until_complete(cor)
+    loop.run_until_complete(registry.close())  # 连接池属于当前事件循环, 结束前关闭
     if loop.is_running():
         loop.close()
     logger.info("run_days()执行完成")
@@ -310,6 +437,7 @@ def sync_by_update_time():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.run_until_complete(cor)
+    loop.run_until_complete(registry.close())  # 连接池属于当前事件循环, 结束前关闭
     if loop.is_running():
         loop.close()
     logger.info("main()执行完成")
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api.metrics import default_registry
+from models.pdd import DB_ASYNC, get_async_session_factory, session_factory
+
+
+"""
+拉取和入库解耦: 拉取协程把写库任务放进有界队列, 单独的写入协程按批取出, 每批一个事务
+同步模式在写库线程中用 psycopg2 执行, 异步模式用 AsyncSession.run_sync 执行, 写库任务的代码两种模式通用
+"""
+
+QUEUE_DEPTH = default_registry.gauge("pdd_pipeline_queue_depth", "写库队列中等待的任务数")
+FLUSH_LATENCY = default_registry.histogram("pdd_db_flush_seconds", "每批写库任务从开始执行到事务提交的耗时")
+FLUSH_JOBS = default_registry.counter("pdd_db_jobs_total", "写库任务数, result 为 ok/error", ["result"])
+
+
+class WritePipeline:
+    """
+    写库任务为 fn(session, *args), 同一批的任务在同一个事务中按提交顺序执行
+    submit 返回的 future 在任务所在的事务提交后得到 fn 的返回值; 队列满时 submit 会等待, 拉取速度受写库速度约束
+    :param maxsize:     队列长度
+    :param batch_size:  每个事务最多包含的任务数
+    :param use_async:   是否使用异步 engine, 默认取 models.pdd.DB_ASYNC
+    """
+
+    def __init__(self, maxsize=16, batch_size=8, use_async=None):
+        self.queue = asyncio.Queue(maxsize)
+        self.batch_size = batch_size
+        self.use_async = DB_ASYNC if use_async is None else use_async
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdd-writer")
+        self._writer = None
+
+    async def __aenter__(self):
+        self._writer = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.queue.put(None)
+        await self._writer
+        self._executor.shutdown()
+
+    async def submit(self, fn, *args):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((fn, args, future))
+        QUEUE_DEPTH.set(self.queue.qsize())
+        return future
+
+    async def run(self, fn, *args):
+        """提交任务并等待事务提交"""
+        return await (await self.submit(fn, *args))
+
+    async def _write(self, batch):
+        started = time.perf_counter()
+        if self.use_async:
+            results = await write_batch_async(batch)
+        else:
+            results = await asyncio.get_running_loop().run_in_executor(self._executor, write_batch, batch)
+        FLUSH_LATENCY.observe(time.perf_counter() - started)
+        return results
+
+    async def _run(self):
+        closed = False
+        while not closed:
+            batch = []
+            job = await self.queue.get()
+            while job is not None:
+                batch.append(job)
+                if len(batch) >= self.batch_size or self.queue.empty():
+                    break
+                job = self.queue.get_nowait()
+            closed = job is None
+            QUEUE_DEPTH.set(self.queue.qsize())
+            if not batch:
+                continue
+            try:
+                results = await self._write(batch)
+            except Exception:
+                # 整批失败时逐个任务单独提交, 只让出错的任务失败
+                for job in batch:
+                    try:
+                        result = await self._write([job])
+                    except Exception as e:
+                        FLUSH_JOBS.inc(result="error")
+                        set_future(job[2], exception=e)
+                    else:
+                        FLUSH_JOBS.inc(result="ok")
+                        set_future(job[2], result=result[0])
+            else:
+                FLUSH_JOBS.inc(len(batch), result="ok")
+                for job, result in zip(batch, results):
+                    set_future(job[2], result=result)
+
+
+def run_jobs(session, batch):
+    return [fn(session, *args) for fn, args, _ in batch]
+
+
+def write_batch(batch):
+    session = session_factory()
+    try:
+        results = run_jobs(session, batch)
+        session.commit()
+        return results
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+async def write_batch_async(batch):
+    async with get_async_session_factory()() as session:
+        try:
+            results = await session.run_sync(run_jobs, batch)
+            await session.commit()
+            return results
+        except Exception:
+            await session.rollback()
+            raise
+
+
+def set_future(future, result=None, exception=None):
+    if future.cancelled():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
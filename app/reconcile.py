@@ -0,0 +1,118 @@
+import asyncio
+import traceback
+from app import settings
+from app.pdd import create_pipeline, limiter, registry, run_malls, write_metrics
+from app.writer import update_orders
+from api.metrics import default_registry
+from datetime import timedelta, datetime as dt
+from logger import get_logger
+from models.pdd import OPEN_ORDER, Order
+
+
+"""
+订单状态对账: 按店铺扫描未签收或售后处理中的订单, 用 pdd.order.status.get 每次查询 100 个订单的状态,
+只更新发货状态/售后状态有变化的订单; 比重新拉取完整订单便宜得多, 可以高频运行
+
+    python -m app.reconcile
+"""
+
+logger = get_logger("pdd_reconcile")
+STATUS_BATCH_SIZE = 100  # pdd.order.status.get 每次最多查询的订单数
+RECONCILE_CONCURRENCY = getattr(settings, "RECONCILE_CONCURRENCY", 5)
+RECONCILE_DAYS = getattr(settings, "RECONCILE_DAYS", 90)  # 拼多多只能查询成交时间三个月以内的订单
+
+RECONCILED = default_registry.counter(
+    "pdd_reconciled_orders_total", "对账的订单数, result 为 checked/changed/missing", ["result"])
+
+
+async def reconcile_orders_():
+    since = dt.now() - timedelta(days=RECONCILE_DAYS)
+    async with create_pipeline() as pipeline:
+        malls = await registry.get_malls(pipeline)
+        await run_malls(malls, lambda mall_obj: reconcile_mall(mall_obj, pipeline, since))
+    logger.info("拼多多接口限流统计: %s" % limiter.stats())
+    write_metrics()
+
+
+async def reconcile_mall(mall_obj, pipeline, since):
+    """按 id 顺序每次取 RECONCILE_CONCURRENCY 批订单并发查询, 有变化的订单放进写库队列后继续下一轮"""
+    pdd = registry.get_client(mall_obj)
+
+    async def fetch(so_nos):
+        try:
+            result, err = await pdd.get_order_status(",".join(so_nos))
+            if err:
+                raise Exception(err)
+        except Exception as e:
+            logger.error("%s 查询订单状态失败: %s \n %s" % (mall_obj.erp_name, e, traceback.format_exc()))
+            return None
+        return {i["orderSn"]: i for i in result}
+
+    last_id = None
+    checked_count = changed_count = 0
+    futures = []
+    while True:
+        order_rows = await pipeline.run(
+            get_open_orders, mall_obj.id, since, last_id, STATUS_BATCH_SIZE * RECONCILE_CONCURRENCY)
+        if not order_rows:
+            break
+        last_id = order_rows[-1].id
+
+        batches = [order_rows[k:k + STATUS_BATCH_SIZE] for k in range(0, len(order_rows), STATUS_BATCH_SIZE)]
+        results = await asyncio.gather(*[fetch([row.so_no for row in batch]) for batch in batches])
+
+        rows = []
+        for batch, statuses in zip(batches, results):
+            if statuses is None:  # 请求失败的批次下次运行再查
+                continue
+            for row in batch:
+                status = statuses.get(row.so_no)
+                if status is None:
+                    RECONCILED.inc(result="missing")
+                    continue
+                changes = get_status_changes(row, status)
+                if changes:
+                    changes["id"] = row.id
+                    rows.append(changes)
+            checked_count += len(batch)
+        changed_count += len(rows)
+        if rows:
+            futures.append(await pipeline.submit(update_orders, rows))
+    await asyncio.gather(*futures)
+    RECONCILED.inc(checked_count, result="checked")
+    RECONCILED.inc(changed_count, result="changed")
+    logger.info("%s 订单状态对账完毕, 查询%d条, 更新%d条" % (mall_obj.erp_name, checked_count, changed_count))
+
+
+def get_status_changes(row, status):
+    """:return: {列名: 新值}, 只包含有变化的列"""
+    changes = {}
+    if status["order_status"] != row.order_status:
+        changes["order_status"] = status["order_status"]
+    if status["refund_status"] != row.refund_status:
+        changes["refund_status"] = status["refund_status"]
+    return changes
+
+
+def get_open_orders(session, mall_id, since, last_id, limit):
+    """按 id 顺序取店铺中成交时间在 since 之后、未签收或售后处理中的订单"""
+    query = session.query(Order.id, Order.so_no, Order.order_status, Order.refund_status).filter(
+        Order.mall_id == mall_id, OPEN_ORDER, Order.confirm_time >= since)
+    if last_id is not None:
+        query = query.filter(Order.id > last_id)
+    return query.order_by(Order.id).limit(limit).all()
+
+
+def reconcile_orders():
+    cor = reconcile_orders_()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(cor)
+    loop.run_until_complete(registry.close())  # 连接池属于当前事件循环, 结束前关闭
+    if loop.is_running():
+        loop.close()
+    logger.info("reconcile_orders()执行完成")
+
+
+if __name__ == "__main__":
+    reconcile_orders()
@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+from app import settings
+from app.pdd import PAGE_CONCURRENCY, create_pipeline, gather_window, get_pending_windows, limiter, registry, \
+    run_malls, run_windows, write_metrics
+from app.sales import SalesDelta, get_row_contribution, lock_orders
+from datetime import timedelta, datetime as dt
+from sqlalchemy import BigInteger, Integer, Numeric, String, cast, column, or_, update, values
+from logger import get_logger
+from models.pdd import Order, RefundMonitor
+
+
+"""
+按售后单更新时间增量同步售后信息, 进度单独记录在 refund_monitor
+每个 30 分钟窗口分页拉取所有状态的售后单, 每页一条 UPDATE 批量更新到订单上, 不再逐个订单查询售后单详情
+只有退款成功(after_sales_status = 10)的售后单写入退款金额, 其他状态的售后单清空退款金额;
+订单已经记录了另一个售后单的退款时, 不被其他未成功的售后单覆盖
+
+    python -m app.refund
+"""
+
+logger = get_logger("pdd_refund")
+REFUND_INITIAL_DAYS = getattr(settings, "REFUND_INITIAL_DAYS", 1)  # 没有进度的店铺从几天前开始同步
+AFTER_SALES_STATUS_ALL = 1
+AFTER_SALES_STATUS_REFUNDED = 10  # 退款成功
+AFTER_SALES_TYPE_ALL = 1
+
+
+async def sync_refunds_():
+    async with create_pipeline() as pipeline:
+        malls = await registry.get_malls(pipeline)
+        await run_malls(malls, lambda mall_obj: sync_mall_refunds(mall_obj, pipeline))
+    logger.info("拼多多接口限流统计: %s" % limiter.stats())
+    write_metrics()
+
+
+async def sync_mall_refunds(mall_obj, pipeline):
+    """与订单增量同步相同, 售后单页拉到后直接放进写库队列, 进度严格按窗口先后顺序提交"""
+    pdd = registry.get_client(mall_obj)
+    last_run_ts = await pipeline.run(get_last_refund_ts, mall_obj.id)
+    if last_run_ts is None:
+        last_run_ts = int((dt.now() - timedelta(days=REFUND_INITIAL_DAYS)).timestamp())
+    windows = get_pending_windows(last_run_ts)
+    if len(windows) > 1:
+        logger.info("%s 售后同步进度落后, 待追赶窗口%d个" % (mall_obj.erp_name, len(windows)))
+
+    async def fetch(begin, end, futures):
+        async for refund_list in pdd.iter_pages(
+                pdd.get_refund_list_increment, "refund_list", begin, end, prefetch=PAGE_CONCURRENCY,
+                after_sales_status=AFTER_SALES_STATUS_ALL, after_sales_type=AFTER_SALES_TYPE_ALL):
+            futures.append(await pipeline.submit(apply_refunds, mall_obj.id, get_refund_rows(refund_list)))
+
+    async def finish(begin, end, futures, previous):
+        total_count = updated_count = 0
+        for page_count, updated in await gather_window(futures, previous):
+            total_count += page_count
+            updated_count += updated
+        await pipeline.run(save_refund_monitor, mall_obj.id, end, total_count, updated_count)
+        logger.info("%s %s -> %s 售后同步完毕, 售后单%s, 更新订单%s" % (
+            mall_obj.erp_name, begin, end, total_count, updated_count))
+
+    await run_windows(windows, fetch, finish)
+
+
+def get_refund_rows(refund_list):
+    """
+    售后单转换为订单的更新内容, 同一订单有多个售后单时优先保留退款成功的, 其次保留更新时间最新的
+    :return: [(so_no, after_sales_id, after_sales_type, goods_number, refund_amount)], 没有退款成功时 refund_amount 为 None
+    """
+    latest = {}
+    for refund in refund_list:
+        prev = latest.get(refund["order_sn"])
+        if prev is None or get_refund_priority(prev) <= get_refund_priority(refund):
+            latest[refund["order_sn"]] = refund
+    return [
+        (so_no, r["id"], r["after_sales_type"], r["goods_number"],
+         r["refund_amount"] / 100 if r["after_sales_status"] == AFTER_SALES_STATUS_REFUNDED else None)
+        for so_no, r in latest.items()
+    ]
+
+
+def get_refund_priority(refund):
+    return refund["after_sales_status"] == AFTER_SALES_STATUS_REFUNDED, refund.get("updated_time", "")
+
+
+def apply_refunds(session, mall_id, rows):
+    """
+    按 (mall_id, so_no) 一条 UPDATE ... FROM (VALUES ...) 批量更新订单的售后信息, 退款金额的差额累加到 daily_sales
+    没有退款成功的售后单只更新没有退款金额、或者记录的就是这个售后单的订单
+    :return: (售后单数, 更新到的订单数)
+    """
+    if not rows:
+        return 0, 0
+    refund_amounts = {row[0]: row[4] for row in rows}
+    old_rows = lock_orders(session, Order.mall_id == mall_id, Order.so_no.in_(list(refund_amounts)))
+    data = values(
+        column("so_no", String),
+        column("after_sales_id", BigInteger),
+        column("after_sales_type", Integer),
+        column("goods_number", Integer),
+        column("refund_amount", Numeric(10, 2)),
+        name="refund",
+    ).data(rows)
+    updated_ids = set(session.execute(
+        update(Order)
+        .where(
+            Order.mall_id == mall_id,
+            Order.so_no == data.c.so_no,
+            or_(
+                data.c.refund_amount.isnot(None),
+                Order.refund_amount.is_(None),
+                Order.after_sales_id == data.c.after_sales_id,
+            ),
+        )
+        .values(
+            after_sales_id=data.c.after_sales_id,
+            after_sales_type=data.c.after_sales_type,
+            goods_number=data.c.goods_number,
+            # 一页都不是退款成功的售后单时 VALUES 中全是 NULL, PostgreSQL 会推断为 text 类型
+            refund_amount=cast(data.c.refund_amount, Numeric(10, 2)),
+        )
+        .returning(Order.id)
+        .execution_options(synchronize_session=False)
+    ).scalars())
+    delta = SalesDelta()
+    for old in old_rows:
+        if old.id in updated_ids:
+            delta.add(mall_id, get_row_contribution(old), get_row_contribution(old, refund_amounts[old.so_no]))
+    delta.apply(session)
+    return len(rows), len(updated_ids)
+
+
+def get_last_refund_ts(session, mall_id):
+    return session.query(RefundMonitor.last_run_ts).filter(
+        RefundMonitor.mall_id == mall_id).order_by(RefundMonitor.last_run_ts.desc()).limit(1).scalar()
+
+
+def save_refund_monitor(session, mall_id, last_run, total_count, updated_count):
+    session.add(RefundMonitor(**{
+        "mall_id": mall_id,
+        "last_run_ts": last_run,
+        "last_run_time": datetime.datetime.fromtimestamp(last_run),
+        "total_count": total_count,
+        "updated_count": updated_count,
+    }))
+
+
+def sync_refunds():
+    cor = sync_refunds_()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(cor)
+    loop.run_until_complete(registry.close())  # 连接池属于当前事件循环, 结束前关闭
+    if loop.is_running():
+        loop.close()
+    logger.info("sync_refunds()执行完成")
+
+
+if __name__ == "__main__":
+    sync_refunds()
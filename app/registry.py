@@ -0,0 +1,77 @@
+import time
+
+from api.pdd import Pdd
+from models.pdd import Mall
+
+
+class MallRegistry:
+    """
+    店铺列表在第一次使用时才查询数据库, 之后每隔 ttl 秒只查询 updated_at 有变化的店铺;
+    每个店铺缓存一个 Pdd 实例(连接池/店铺信息等缓存跨多次同步复用), token 变化时直接更新到原实例上
+    :param ttl:             刷新间隔(秒)
+    :param client_kwargs:   创建 Pdd 实例的其他参数, 如 limiter
+    """
+
+    def __init__(self, ttl=300, **client_kwargs):
+        self.ttl = ttl
+        self._client_kwargs = client_kwargs
+        self._malls = {}  # {mall_id: Row}
+        self._clients = {}  # {mall_id: Pdd}
+        self._retired = []  # 被替换或停用的 Pdd 实例, 等待关闭连接池
+        self._loaded_at = None  # 还没有加载过; time.monotonic() 从开机开始计时, 不能用 0 表示
+        self._last_updated_at = None
+
+    async def get_malls(self, pipeline):
+        """当前启用的店铺列表, 需要时通过写库队列刷新"""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl:
+            self._apply(await pipeline.run(load_malls, self._last_updated_at))
+            self._loaded_at = time.monotonic()
+        await self._close_retired()
+        return list(self._malls.values())
+
+    def get_client(self, mall_obj):
+        client = self._clients.get(mall_obj.id)
+        if client is None or (client.client_id, client.client_secret) != (mall_obj.client_id, mall_obj.client_secret):
+            if client is not None:
+                self._retired.append(client)
+            client = self._clients[mall_obj.id] = Pdd(
+                mall_obj.client_id, mall_obj.client_secret, mall_obj.token, **self._client_kwargs)
+        elif client.access_token != mall_obj.token:
+            client.access_token = mall_obj.token
+        return client
+
+    def invalidate(self):
+        """下次 get_malls 时强制刷新"""
+        self._loaded_at = None
+
+    async def close(self):
+        """关闭所有店铺的连接池, Pdd 实例保留, 下次使用时重新建立连接"""
+        for client in self._clients.values():
+            await client.close()
+        await self._close_retired()
+
+    async def _close_retired(self):
+        while self._retired:
+            await self._retired.pop().close()
+
+    def _apply(self, rows):
+        for row in rows:
+            if row.active:
+                self._malls[row.id] = row
+            else:
+                self._malls.pop(row.id, None)
+                if row.id in self._clients:
+                    self._retired.append(self._clients.pop(row.id))
+            if row.updated_at and (self._last_updated_at is None or row.updated_at > self._last_updated_at):
+                self._last_updated_at = row.updated_at
+
+
+def load_malls(session, updated_after=None):
+    """第一次加载所有启用的店铺, 之后只加载 updated_at 在 updated_after 之后的店铺(包括被停用的)"""
+    query = session.query(
+        Mall.id, Mall.erp_name, Mall.client_id, Mall.client_secret, Mall.token, Mall.active, Mall.updated_at)
+    if updated_after is None:
+        query = query.filter(Mall.active.is_(True))
+    else:
+        query = query.filter(Mall.updated_at > updated_after)
+    return query.order_by(Mall.id).all()
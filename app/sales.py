@@ -0,0 +1,138 @@
+import argparse
+from collections import defaultdict
+from datetime import timedelta, datetime as dt
+from decimal import Decimal
+
+from sqlalchemy import Date, and_, case, cast, delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models.pdd import DailySales, Order, session_factory
+
+
+"""
+daily_sales 的维护: 订单写入/退款更新时在同一个事务中按 (店铺, 成交日期) 累加新旧值的差额
+只统计已成交(confirm_status = 1)的订单, 汇总出现偏差时按日期范围重建:
+
+    python -m app.sales --begin 2026-07-01 --end 2026-09-30
+"""
+
+SALES_COLUMNS = ("order_count", "goods_amount", "discount_amount", "pay_amount", "refund_count", "refund_amount")
+# 计算汇总需要的订单字段, 写入前用 SELECT ... FOR UPDATE 取旧值
+SOURCE_COLUMNS = (Order.id, Order.so_no, Order.mall_id, Order.confirm_time, Order.confirm_status, Order.goods_amount,
+                  Order.discount_amount, Order.pay_amount, Order.refund_amount)
+
+
+def get_contribution(confirm_time, confirm_status, goods_amount, discount_amount, pay_amount, refund_amount):
+    """
+    一个订单对 daily_sales 的贡献
+    :return: (成交日期, (订单数, 商品金额, 折扣金额, 支付金额, 退款订单数, 退款金额)), 不计入汇总时为 None
+    """
+    if confirm_time is None or confirm_status != 1:
+        return None
+    return confirm_time.date(), (
+        1,
+        to_decimal(goods_amount),
+        to_decimal(discount_amount),
+        to_decimal(pay_amount),
+        0 if refund_amount is None else 1,
+        to_decimal(refund_amount),
+    )
+
+
+_UNCHANGED = object()
+
+
+def get_row_contribution(row, refund_amount=_UNCHANGED):
+    """数据库中的订单行(SOURCE_COLUMNS), 传入 refund_amount 时按新的退款金额计算, None 为没有退款"""
+    return get_contribution(row.confirm_time, row.confirm_status, row.goods_amount, row.discount_amount,
+                            row.pay_amount, row.refund_amount if refund_amount is _UNCHANGED else refund_amount)
+
+
+def to_decimal(value):
+    if value is None:
+        return Decimal(0)
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+class SalesDelta:
+    """同一个事务中各 (店铺, 成交日期) 的变化量, 最后一条 upsert 累加到 daily_sales"""
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: [0] * len(SALES_COLUMNS))
+
+    def add(self, mall_id, old, new):
+        """old/new 为 get_contribution 的返回值"""
+        for contribution, sign in ((old, -1), (new, 1)):
+            if contribution is None:
+                continue
+            day, values = contribution
+            delta = self._deltas[(mall_id, day)]
+            for i, value in enumerate(values):
+                delta[i] += sign * value
+
+    def apply(self, session):
+        # 按 (店铺, 日期) 排序写入, 并发事务按相同顺序加锁, 避免死锁
+        rows = [
+            dict(zip(SALES_COLUMNS, values), mall_id=mall_id, day=day)
+            for (mall_id, day), values in sorted(self._deltas.items())
+            if any(values)
+        ]
+        self._deltas.clear()
+        if not rows:
+            return
+        table = DailySales.__table__
+        stmt = pg_insert(DailySales).values(rows)
+        set_ = {c: table.c[c] + stmt.excluded[c] for c in SALES_COLUMNS}
+        set_["updated_at"] = func.now()
+        session.execute(stmt.on_conflict_do_update(index_elements=[table.c.mall_id, table.c.day], set_=set_))
+
+
+def lock_orders(session, *where):
+    """取订单的旧值并锁定到事务结束(按 id 顺序加锁), 保证差额基于最新提交的数据"""
+    return session.execute(select(*SOURCE_COLUMNS).where(*where).order_by(Order.id).with_for_update()).all()
+
+
+def rebuild_daily_sales(session, begin_date, end_date):
+    """
+    按订单表重新计算 begin_date ~ end_date(含)的汇总, 不提交事务
+    重建期间锁住 daily_sales, 同时写入的订单等重建提交后再累加差额
+    """
+    session.execute(text("LOCK TABLE daily_sales IN SHARE ROW EXCLUSIVE MODE"))
+    session.execute(delete(DailySales).where(DailySales.day >= begin_date, DailySales.day <= end_date))
+    begin = dt.combine(begin_date, dt.min.time())
+    end = dt.combine(end_date + timedelta(days=1), dt.min.time())
+    day = cast(Order.confirm_time, Date)
+    refunded = Order.refund_amount.isnot(None)
+    query = select(
+        Order.mall_id,
+        day,
+        func.count(),
+        func.coalesce(func.sum(Order.goods_amount), 0),
+        func.coalesce(func.sum(Order.discount_amount), 0),
+        func.coalesce(func.sum(Order.pay_amount), 0),
+        func.count(case((refunded, 1))),
+        func.coalesce(func.sum(Order.refund_amount), 0),
+    ).where(
+        and_(Order.confirm_status == 1, Order.confirm_time >= begin, Order.confirm_time < end)
+    ).group_by(Order.mall_id, day)
+    result = session.execute(pg_insert(DailySales).from_select(("mall_id", "day") + SALES_COLUMNS, query))
+    return result.rowcount
+
+
+if __name__ == "__main__":
+    from logger import get_logger
+
+    def to_date(value):
+        return dt.strptime(value, "%Y-%m-%d").date()
+
+    parser = argparse.ArgumentParser(description="按订单表重建 daily_sales")
+    parser.add_argument("--begin", type=to_date, required=True, help="开始日期 YYYY-MM-DD")
+    parser.add_argument("--end", type=to_date, help="结束日期 YYYY-MM-DD, 默认当天")
+    args = parser.parse_args()
+    end_date = args.end or dt.now().date()
+    with session_factory() as session:
+        count = rebuild_daily_sales(session, args.begin, end_date)
+        session.commit()
+    get_logger("pdd_sales").info("重建 %s ~ %s 的销售汇总 %d 条" % (args.begin, end_date, count))
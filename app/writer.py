@@ -0,0 +1,302 @@
+import json
+import uuid
+from datetime import datetime
+from hashlib import md5
+
+from sqlalchemy import delete, func, literal_column, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.sales import SalesDelta, get_contribution, get_row_contribution, lock_orders
+from models.pdd import Order, Item
+
+
+"""
+订单批量入库, 一页订单只需要 查询已有订单 / insert 新订单 / upsert 有变化的订单 / upsert item / delete 多余 item 几条语句
+内容没有变化的订单(content_hash 相同或拼多多返回的数据比库里旧)直接跳过, 不产生写入
+写入的订单在同一个事务中按新旧值的差额更新 daily_sales
+"""
+
+# 拼多多有值时才覆盖的字段, 没有值时保留数据库中已有的(比如从聚水潭补充的收货信息)
+ORDER_OPTIONAL_COLUMNS = ("shipping_time", "buyer_account", "province", "city", "town")
+
+# 订单字段: (列名, 拼多多字段名)
+ORDER_FIELDS = (
+    ("so_no", "order_sn"),
+    ("confirm_time", "confirm_time"),
+    ("so_created_at", "created_time"),
+    ("so_updated_at", "updated_at"),
+    ("confirm_status", "confirm_status"),
+    ("refund_status", "refund_status"),
+    ("after_sales_status", "after_sales_status"),
+    ("order_status", "order_status"),
+    ("risk_control_status", "risk_control_status"),
+    ("goods_amount", "goods_amount"),
+    ("discount_amount", "discount_amount"),
+    ("seller_discount", "seller_discount"),
+    ("platform_discount", "platform_discount"),
+    ("order_change_amount", "order_change_amount"),
+    ("capital_free_discount", "capital_free_discount"),
+    ("pay_amount", "pay_amount"),
+    ("postage", "postage"),
+    ("logistics_id", "logistics_id"),
+    ("tracking_number", "tracking_number"),
+)
+ORDER_COLUMNS = tuple(c for c, _ in ORDER_FIELDS) + ("service_fee",) + ORDER_OPTIONAL_COLUMNS
+# 拼多多返回 "%Y-%m-%d %H:%M:%S" 字符串的时间字段
+ORDER_DATETIME_COLUMNS = ("confirm_time", "so_created_at", "so_updated_at", "shipping_time")
+ITEM_FIELDS = (
+    ("qty", "goods_count"),
+    ("goods_price", "goods_price"),
+    ("goods_name", "goods_name"),
+    ("goods_spec", "goods_spec"),
+    ("goods_id", "goods_id"),
+    ("sku_id", "sku_id"),
+    ("outer_id", "outer_id"),
+)
+ITEM_COLUMNS = tuple(c for c, _ in ITEM_FIELDS)
+
+
+class OrderRecord:
+    """
+    只保留入库需要的字段, 拉到订单页后立即转换, 写库队列中不再保留接口返回的完整 dict
+    没有值的可选字段为 None
+    """
+    __slots__ = ORDER_COLUMNS + ("items",)
+
+    def __init__(self, json_obj):
+        for column, key in ORDER_FIELDS:
+            setattr(self, column, json_obj[key])
+        fee = 0.0
+        if json_obj["service_fee_detail"]:
+            for i in json_obj["service_fee"]:
+                fee += i
+        self.service_fee = fee
+        self.shipping_time = json_obj["shipping_time"] or None
+        if json_obj["province"]:
+            self.buyer_account = json_obj["receiver_phone"]
+            self.province = json_obj["province"]
+            self.city = json_obj["city"]
+            self.town = json_obj["town"]
+        else:
+            self.buyer_account = self.province = self.city = self.town = None
+        self.items = [ItemRecord(item) for item in json_obj["item_list"]]
+
+    def to_row(self):
+        return {c: getattr(self, c) for c in ORDER_COLUMNS}
+
+    def to_db_row(self):
+        """写库的订单数据, 时间字符串转成 datetime(asyncpg 不接受字符串); to_row 保留接口返回的原值, content_hash 不受影响"""
+        row = self.to_row()
+        for c in ORDER_DATETIME_COLUMNS:
+            row[c] = to_datetime(row[c])
+        return row
+
+    def to_hash_data(self):
+        """没有值的可选字段不出现, 与之前逐条入库时的订单数据相同, 保证 content_hash 与之前一致"""
+        data = self.to_row()
+        for c in ORDER_OPTIONAL_COLUMNS:
+            if data[c] is None:
+                del data[c]
+        return data
+
+
+class ItemRecord:
+    __slots__ = ITEM_COLUMNS
+
+    def __init__(self, json_obj):
+        for column, key in ITEM_FIELDS:
+            setattr(self, column, json_obj[key])
+
+    def to_row(self):
+        return {c: getattr(self, c) for c in ITEM_COLUMNS}
+
+    def to_db_row(self):
+        """
+        写库的明细数据, 拼多多返回的 goods_id/sku_id 是整数, 转成与数据库列相同的字符串, 否则按自然键比较时类型不匹配
+        to_row 保留接口返回的原值, content_hash 不受影响
+        """
+        row = self.to_row()
+        row["goods_id"] = to_text(self.goods_id)
+        row["sku_id"] = to_text(self.sku_id)
+        return row
+
+
+def to_records(order_list):
+    return [OrderRecord(o) for o in order_list]
+
+
+def upsert_orders(session, mall_id, orders):
+    """
+    :param session:     sqlalchemy session, 由调用方提交事务
+    :param mall_id:     店铺id
+    :param orders:      [OrderRecord]
+    :return:            (upsert 后的订单行 [Row(id, so_no, inserted)], 没有变化被跳过的订单行 [Row(id, so_no, ...)])
+    """
+    # 同一批次中重复的订单只保留更新时间最新的一条, 否则 ON CONFLICT 会报错
+    latest = {}
+    for order in orders:
+        prev = latest.get(order.so_no)
+        if prev is None or prev.so_updated_at <= order.so_updated_at:
+            latest[order.so_no] = order
+    if not latest:
+        return [], []
+
+    table = Order.__table__
+    hashes = {so_no: get_content_hash(order) for so_no, order in latest.items()}
+    # 锁定已有订单到事务结束, daily_sales 的差额基于这里读到的旧值
+    old_rows = lock_existing(session, mall_id, list(latest))
+    rows = []
+    new_orders = sorted(so_no for so_no in latest if so_no not in old_rows)
+    if new_orders:
+        # 认为是新订单的只插入不更新, 并发事务已经插入同一订单时 ON CONFLICT DO NOTHING 等它提交后跳过,
+        # 再锁定读出它写入的内容按已有订单处理, 否则两个事务都按新订单计入 daily_sales
+        stmt = pg_insert(Order).values([get_order_row(latest[so_no], mall_id, hashes[so_no]) for so_no in new_orders])
+        inserted = session.execute(
+            stmt.on_conflict_do_nothing(index_elements=[table.c.mall_id, table.c.so_no])
+            .returning(table.c.id, table.c.so_no, literal_column("true").label("inserted"))
+        ).all()
+        rows.extend(inserted)
+        conflicted = set(new_orders).difference(row.so_no for row in inserted)
+        if conflicted:
+            old_rows.update(lock_existing(session, mall_id, list(conflicted)))
+
+    unchanged = []
+    for row in old_rows.values():
+        incoming = latest[row.so_no].so_updated_at
+        if row.content_hash == hashes[row.so_no] or (
+                row.so_updated_at is not None and to_datetime(incoming) < row.so_updated_at):
+            unchanged.append(row)
+            del latest[row.so_no]
+    changed = [so_no for so_no in old_rows if so_no in latest]
+    if changed:
+        order_rows = [get_order_row(latest[so_no], mall_id, hashes[so_no]) for so_no in changed]
+        stmt = pg_insert(Order).values(order_rows)
+        set_ = {}
+        for c in order_rows[0]:
+            if c == "id":
+                continue
+            if c in ORDER_OPTIONAL_COLUMNS:
+                set_[c] = func.coalesce(stmt.excluded[c], table.c[c])
+            else:
+                set_[c] = stmt.excluded[c]
+        set_["updated_at"] = func.now()
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.mall_id, table.c.so_no],
+            set_=set_,
+            where=table.c.content_hash.is_distinct_from(stmt.excluded.content_hash),
+        ).returning(
+            table.c.id,
+            table.c.so_no,
+            literal_column("xmax = 0").label("inserted"),
+        )
+        rows.extend(session.execute(stmt).all())
+    if not rows:
+        return [], unchanged
+
+    delta = SalesDelta()
+    for row in rows:
+        order = latest[row.so_no]
+        old = old_rows.get(row.so_no)
+        new = get_contribution(
+            to_datetime(order.confirm_time), order.confirm_status, order.goods_amount, order.discount_amount,
+            order.pay_amount, None if old is None else old.refund_amount)
+        delta.add(mall_id, None if old is None else get_row_contribution(old), new)
+    delta.apply(session)
+
+    order_ids = {row.so_no: row.id for row in rows}
+    item_rows = {}
+    for so_no, order in latest.items():
+        if so_no not in order_ids:  # 并发写入时已经被其他事务更新成相同内容
+            continue
+        for item in order.items:
+            row = item.to_db_row()
+            key = (order_ids[so_no], row["goods_id"], row["sku_id"])
+            if key in item_rows:  # 同一订单中重复的 sku 合并数量
+                item_rows[key]["qty"] += item.qty
+            else:
+                item_rows[key] = row
+                row["id"] = uuid.uuid4()
+                row["order_id"] = key[0]
+    if order_ids:
+        upsert_items(session, list(order_ids.values()), item_rows)
+    return rows, unchanged
+
+
+def lock_existing(session, mall_id, so_nos):
+    """按主键顺序锁定已有订单, :return: {so_no: Row}"""
+    table = Order.__table__
+    existing = session.execute(
+        select(table.c.id, table.c.so_no, table.c.so_updated_at, table.c.content_hash, table.c.confirm_time,
+               table.c.confirm_status, table.c.goods_amount, table.c.discount_amount, table.c.pay_amount,
+               table.c.refund_amount)
+        .where(table.c.mall_id == mall_id, table.c.so_no.in_(so_nos))
+        .order_by(table.c.id)
+        .with_for_update()
+    ).all()
+    return {row.so_no: row for row in existing}
+
+
+def get_order_row(order, mall_id, content_hash):
+    row = order.to_db_row()
+    row["id"] = uuid.uuid4()
+    row["mall_id"] = mall_id
+    row["item_count"] = len(order.items)
+    row["content_hash"] = content_hash
+    return row
+
+
+def get_content_hash(order):
+    """订单和明细内容的 md5, 用来判断订单是否有变化"""
+    text = json.dumps([order.to_hash_data(), [item.to_row() for item in order.items]],
+                      sort_keys=True, ensure_ascii=False, default=str)
+    return md5(text.encode("utf-8")).hexdigest()
+
+
+def to_text(value):
+    return None if value is None else str(value)
+
+
+def to_datetime(value):
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def upsert_items(session, order_ids, item_rows):
+    """
+    按 (order_id, goods_id, sku_id) diff 订单明细: 已有的更新, 新的插入, 不再存在的删除
+    :param order_ids:   本批次的订单id
+    :param item_rows:   {(order_id, goods_id, sku_id): item_data}
+    """
+    stale = delete(Item).where(Item.order_id.in_(order_ids))
+    if item_rows:
+        stmt = pg_insert(Item).values(list(item_rows.values()))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Item.order_id, Item.goods_id, Item.sku_id],
+            set_={c: stmt.excluded[c] for c in ("qty", "goods_price", "goods_name", "goods_spec", "outer_id")},
+        )
+        session.execute(stmt)
+        stale = stale.where(tuple_(Item.order_id, Item.goods_id, Item.sku_id).not_in(list(item_rows)))
+    session.execute(stale)
+
+
+def update_orders(session, rows):
+    """按主键批量更新订单, rows: [{"id": ..., 字段: 值}]"""
+    if rows:
+        session.bulk_update_mappings(Order, rows)
+
+
+def update_refunds(session, rows):
+    """
+    按主键批量更新订单的售后信息, 同时把退款金额的差额累加到 daily_sales
+    :param rows: [{"id": ..., "refund_amount": ..., 其他售后字段: 值}]
+    """
+    if not rows:
+        return
+    old_rows = lock_orders(session, Order.id.in_([row["id"] for row in rows]))
+    update_orders(session, rows)
+    refund_amounts = {row["id"]: row["refund_amount"] for row in rows}
+    delta = SalesDelta()
+    for old in old_rows:
+        delta.add(old.mall_id, get_row_contribution(old), get_row_contribution(old, refund_amounts[old.id]))
+    delta.apply(session)
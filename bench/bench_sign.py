@@ -0,0 +1,51 @@
+"""
+对比原来的 get_sign 写法与 Signer 的签名速度
+
+    python -m bench.bench_sign --number 200000
+"""
+import argparse
+import timeit
+from hashlib import md5
+
+from api.pdd import Signer
+
+
+CLIENT_SECRET = "0123456789abcdef0123456789abcdef01234567"
+PARAMS = {
+    "access_token": "f" * 32,
+    "client_id": "e" * 32,
+    "timestamp": 1700000000,
+    "type": "pdd.order.number.list.increment.get",
+    "start_updated_at": 1700000000,
+    "end_updated_at": 1700001799,
+    "is_lucky_flag": 0,
+    "order_status": 5,
+    "page": 3,
+    "page_size": 100,
+    "refund_status": 5,
+}
+
+
+def legacy_sign(params, client_secret):
+    # 原 api/pdd.py::get_sign 的写法, 仅用作对照
+    sorted_dict = sorted(params.items())
+    text = "".join([''.join((str(k), str(v))) for k, v in sorted_dict])
+    text = "{client_secret}{text}{client_secret}".format(client_secret=client_secret, text=text)
+    return md5(text.encode("utf-8")).hexdigest().upper()
+
+
+def main(number):
+    signer = Signer(CLIENT_SECRET)
+    assert signer.sign(PARAMS) == legacy_sign(PARAMS, CLIENT_SECRET)
+    before = min(timeit.repeat(lambda: legacy_sign(PARAMS, CLIENT_SECRET), number=number, repeat=5)) / number
+    after = min(timeit.repeat(lambda: signer.sign(PARAMS), number=number, repeat=5)) / number
+    print("原写法: %.2f us/次" % (before * 1e6))
+    print("Signer: %.2f us/次" % (after * 1e6))
+    print("提升:   %.2fx" % (before / after))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+    main(args.number)
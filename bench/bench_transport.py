@@ -0,0 +1,63 @@
+"""
+对比每次请求新建 ClientSession 与复用连接池的吞吐量
+
+    python -m bench.bench_transport --requests 2000 --concurrency 20
+"""
+import argparse
+import asyncio
+import time
+
+from aiohttp import web
+
+from api.pdd import create_client_session, send_pdd_request
+
+
+async def handle_router(request):
+    await request.read()
+    return web.json_response({"order_sn_increment_get_response": {"total_count": 0, "order_sn_list": []}})
+
+
+async def start_stub_server(host="127.0.0.1", port=0):
+    app = web.Application()
+    app.router.add_post("/api/router", handle_router)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, "http://%s:%d/api/router" % (host, port)
+
+
+async def run(url, total, concurrency, session=None):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with sem:
+            _, err = await send_pdd_request("POST", url, json={"type": "bench"}, session=session)
+            if err:
+                raise RuntimeError(err)
+
+    begin = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(total)])
+    return total / (time.perf_counter() - begin)
+
+
+async def main(total, concurrency):
+    runner, url = await start_stub_server()
+    try:
+        before = await run(url, total, concurrency)
+        async with create_client_session() as session:
+            after = await run(url, total, concurrency, session=session)
+    finally:
+        await runner.cleanup()
+    print("每次新建 session: %.0f req/s" % before)
+    print("复用连接池:       %.0f req/s" % after)
+    print("提升:             %.2fx" % (after / before))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
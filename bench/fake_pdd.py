@@ -0,0 +1,183 @@
+"""
+本地模拟的拼多多网关, 压测时代替 gw-api.pinduoduo.com
+
+支持 pdd.order.number.list.increment.get / pdd.order.list.get / pdd.refund.information.get,
+可以配置每次查询返回的订单数、响应延迟和限流错误的比例; 同一时间段每次返回相同的订单, 重复同步时订单内容不变
+
+    python -m bench.fake_pdd --port 8800 --orders 500 --latency 30 --throttle-rate 0.02
+"""
+import argparse
+import asyncio
+import random
+import zlib
+from collections import Counter
+from datetime import datetime
+
+from aiohttp import web
+
+
+class FakePddGateway:
+    """
+    :param orders_per_query:    每个查询时间段返回的订单数
+    :param latency:             每个请求的响应延迟(秒)
+    :param throttle_rate:       返回限流错误(52101)的请求比例
+    :param refund_rate:         退款成功(after_sales_status=10)的订单比例
+    :param seed:                限流错误的随机种子
+    """
+
+    def __init__(self, orders_per_query=500, latency=0.0, throttle_rate=0.0, refund_rate=0.05, seed=0):
+        self.orders_per_query = orders_per_query
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.refund_rate = refund_rate
+        self.calls = Counter()  # {api_name: 请求次数}, 包括返回限流错误的请求
+        self.throttled = Counter()
+        self.url = None
+        self._random = random.Random(seed)
+        self._runner = None
+        self._handlers = {
+            "pdd.order.number.list.increment.get": self.order_list_increment,
+            "pdd.order.list.get": self.order_list,
+            "pdd.refund.information.get": self.refund_info,
+        }
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_post("/api/router", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.url = "http://%s:%d/api/router" % (host, self._runner.addresses[0][1])
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    async def handle(self, request):
+        data = await request.json()
+        api_name = data.get("type")
+        self.calls[api_name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.throttle_rate and self._random.random() < self.throttle_rate:
+            self.throttled[api_name] += 1
+            return error_response(52101, "当前接口被限流")
+        handler = self._handlers.get(api_name)
+        if handler is None:
+            return error_response(10000, "不支持的接口 %s" % api_name)
+        return web.json_response(handler(data))
+
+    def get_orders(self, client_id, begin, end):
+        step = max(1, (end - begin) // max(1, self.orders_per_query))
+        return [
+            make_order(client_id, begin, n, begin + min(n * step, end - begin), self.refund_rate)
+            for n in range(self.orders_per_query)
+        ]
+
+    def get_page(self, data, begin_key, end_key):
+        orders = self.get_orders(data["client_id"], int(data[begin_key]), int(data[end_key]))
+        page, page_size = int(data.get("page", 1)), int(data.get("page_size", 100))
+        page_list = orders[(page - 1) * page_size:page * page_size]
+        if data.get("use_has_next") == "true":
+            return {"has_next": page * page_size < len(orders)}, page_list
+        return {"total_count": len(orders)}, page_list
+
+    def order_list_increment(self, data):
+        result, page_list = self.get_page(data, "start_updated_at", "end_updated_at")
+        result["order_sn_list"] = page_list
+        return {"order_sn_increment_get_response": result}
+
+    def order_list(self, data):
+        result, page_list = self.get_page(data, "start_confirm_at", "end_confirm_at")
+        result["order_list"] = page_list
+        return {"order_list_get_response": result}
+
+    def refund_info(self, data):
+        # 与 Pdd.get_refund_info 的使用方式一致, 售后单字段直接在返回结果中
+        order_sn = data["order_sn"]
+        return {
+            "id": zlib.crc32(order_sn.encode("utf-8")),
+            "order_sn": order_sn,
+            "after_sales_type": 2,
+            "goods_number": 1,
+            "refund_amount": 4950,
+        }
+
+
+def error_response(code, msg):
+    return web.json_response({"error_response": {"error_code": code, "error_msg": msg}})
+
+
+def make_order(client_id, begin, n, ts, refund_rate=0.0):
+    time_str = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+    item_count = n % 3 + 1
+    refunded = (n % 100) < refund_rate * 100
+    return {
+        "order_sn": "%s-%s-%010d-%05d" % (datetime.fromtimestamp(begin).strftime("%y%m%d"), client_id, begin, n),
+        "confirm_time": time_str,
+        "created_time": time_str,
+        "updated_at": time_str,
+        "confirm_status": 1,
+        "refund_status": 4 if refunded else 1,
+        "after_sales_status": 10 if refunded else 0,
+        "order_status": 1,
+        "risk_control_status": 0,
+        "goods_amount": 49.5 * item_count,
+        "discount_amount": 0,
+        "seller_discount": 0,
+        "platform_discount": 0,
+        "order_change_amount": 0,
+        "capital_free_discount": 0,
+        "pay_amount": 49.5 * item_count,
+        "postage": 0,
+        "logistics_id": 0,
+        "tracking_number": "",
+        "service_fee_detail": [],
+        "shipping_time": "",
+        "province": "",
+        "item_list": [{
+            "goods_count": 1,
+            "goods_price": 49.5,
+            "goods_name": "商品%d" % i,
+            "goods_spec": "规格%d" % i,
+            "goods_id": i,  # 与拼多多接口相同, goods_id/sku_id 为整数
+            "sku_id": i * 10,
+            "outer_id": "",
+        } for i in range(item_count)],
+    }
+
+
+async def serve(host, port, **kwargs):
+    gateway = FakePddGateway(**kwargs)
+    await gateway.start(host, port)
+    print("模拟网关 %s" % gateway.url)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await gateway.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--orders", type=int, default=500, help="每个查询时间段返回的订单数")
+    parser.add_argument("--latency", type=float, default=0, help="响应延迟(毫秒)")
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--refund-rate", type=float, default=0.05)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, orders_per_query=args.orders, latency=args.latency / 1000,
+                      throttle_rate=args.throttle_rate, refund_rate=args.refund_rate))
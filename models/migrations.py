@@ -0,0 +1,131 @@
+import re
+
+from models.pdd import engine
+
+
+"""
+已有数据库的结构升级, 可以重复执行
+索引使用 CONCURRENTLY 创建, 不会锁表; 建唯一索引前先清理历史重复数据
+CONCURRENTLY 建索引失败时会留下无效(INVALID)的索引, IF NOT EXISTS 会跳过它, 重新执行时先删除再重建
+
+    python -m models.migrations
+"""
+
+DEDUPE_ORDER = """
+WITH d AS (
+    SELECT id, row_number() OVER (PARTITION BY mall_id, so_no ORDER BY so_updated_at DESC NULLS LAST, updated_at DESC) AS rn
+    FROM "order"
+), dup AS (
+    SELECT id FROM d WHERE rn > 1
+), del_item AS (
+    DELETE FROM item USING dup WHERE item.order_id = dup.id
+)
+DELETE FROM "order" USING dup WHERE "order".id = dup.id
+"""
+
+# 同一订单中重复的 sku 合并数量后只保留一条
+MERGE_ITEM_QTY = """
+WITH d AS (
+    SELECT id, row_number() OVER w AS rn, sum(qty) OVER (PARTITION BY order_id, goods_id, sku_id) AS total
+    FROM item
+    WINDOW w AS (PARTITION BY order_id, goods_id, sku_id ORDER BY created_at DESC, id)
+)
+UPDATE item SET qty = d.total FROM d WHERE item.id = d.id AND d.rn = 1 AND d.total IS DISTINCT FROM item.qty
+"""
+
+DEDUPE_ITEM = """
+WITH d AS (
+    SELECT id, row_number() OVER (PARTITION BY order_id, goods_id, sku_id ORDER BY created_at DESC, id) AS rn
+    FROM item
+)
+DELETE FROM item USING d WHERE item.id = d.id AND d.rn > 1
+"""
+
+CREATE_DAILY_SALES = """
+CREATE TABLE IF NOT EXISTS daily_sales (
+    id SERIAL PRIMARY KEY,
+    mall_id INTEGER REFERENCES mall (id),
+    day DATE,
+    order_count INTEGER DEFAULT 0,
+    goods_amount NUMERIC(14, 2) DEFAULT 0,
+    discount_amount NUMERIC(14, 2) DEFAULT 0,
+    pay_amount NUMERIC(14, 2) DEFAULT 0,
+    refund_count INTEGER DEFAULT 0,
+    refund_amount NUMERIC(14, 2) DEFAULT 0,
+    updated_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now()
+)
+"""
+
+CREATE_REFUND_MONITOR = """
+CREATE TABLE IF NOT EXISTS refund_monitor (
+    id SERIAL PRIMARY KEY,
+    mall_id INTEGER REFERENCES mall (id),
+    last_run_ts INTEGER,
+    last_run_time TIMESTAMP WITHOUT TIME ZONE,
+    total_count INTEGER DEFAULT 0,
+    updated_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now()
+)
+"""
+
+CREATE_BACKFILL_SHARD = """
+CREATE TABLE IF NOT EXISTS backfill_shard (
+    id SERIAL PRIMARY KEY,
+    run_key VARCHAR NOT NULL,
+    mall_id INTEGER REFERENCES mall (id),
+    begin_ts INTEGER,
+    end_ts INTEGER,
+    total_count INTEGER DEFAULT 0,
+    created_count INTEGER DEFAULT 0,
+    updated_count INTEGER DEFAULT 0,
+    unchanged_count INTEGER DEFAULT 0,
+    done_at TIMESTAMP WITHOUT TIME ZONE,
+    created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now()
+)
+"""
+
+IS_INVALID_INDEX = """
+SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %(name)s
+"""
+INDEX_NAME = re.compile(r"INDEX CONCURRENTLY IF NOT EXISTS (\w+)")
+
+STEPS = [
+    'ALTER TABLE "order" ADD COLUMN IF NOT EXISTS privacy_attempts INTEGER DEFAULT 0',
+    'ALTER TABLE "order" ADD COLUMN IF NOT EXISTS privacy_retry_at TIMESTAMP WITHOUT TIME ZONE',
+    'ALTER TABLE "order" ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)',
+    "ALTER TABLE monitor ADD COLUMN IF NOT EXISTS unchanged_count INTEGER DEFAULT 0",
+    DEDUPE_ORDER,
+    'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_order_mall_id_so_no ON "order" (mall_id, so_no)',
+    'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_buyer_account_null ON "order" (id) WHERE buyer_account IS NULL',
+    MERGE_ITEM_QTY,
+    DEDUPE_ITEM,
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_item_order_id_goods_id_sku_id ON item (order_id, goods_id, sku_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_monitor_mall_id_last_run_ts ON monitor (mall_id, last_run_ts DESC)",
+    CREATE_BACKFILL_SHARD,
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_backfill_shard_run_key_mall_id_begin_ts "
+    "ON backfill_shard (run_key, mall_id, begin_ts)",
+    'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_open ON "order" (mall_id, id) '
+    "WHERE confirm_status = 1 AND (order_status <> 3 OR refund_status IN (2, 3))",
+    'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_updated_at ON "order" (updated_at)',
+    'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_refund_pending ON "order" (mall_id) '
+    "WHERE after_sales_status = 10 AND after_sales_id IS NULL",
+    CREATE_REFUND_MONITOR,
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_refund_monitor_mall_id_last_run_ts "
+    "ON refund_monitor (mall_id, last_run_ts DESC)",
+    # 建表后需要用 python -m app.sales 重建历史数据
+    CREATE_DAILY_SALES,
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_daily_sales_mall_id_day ON daily_sales (mall_id, day)",
+]
+
+
+def upgrade(bind=engine):
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for sql in STEPS:
+            match = INDEX_NAME.search(sql)
+            if match and conn.exec_driver_sql(IS_INVALID_INDEX, {"name": match.group(1)}).scalar():
+                conn.exec_driver_sql("DROP INDEX CONCURRENTLY %s" % match.group(1))
+            conn.exec_driver_sql(sql)
+
+
+if __name__ == "__main__":
+    upgrade()